@@ -0,0 +1,308 @@
+"""
+A stand-in for Azure AD and MS Graph to benchmark logins against.
+
+It answers OpenID discovery, the token endpoint and the handful of Graph endpoints the plugin uses.
+Users are generated on the fly: the authorization code `user42.<nonce>` logs in as `user42@bench.example`,
+who is a member of a number of groups picked from --groups by their index. There's no authorize page, so
+the client makes up the code itself and puts the nonce from the authorization URL in it. MSAL doesn't send
+the nonce to the token endpoint, and the id token has to carry it back for MSAL to accept it.
+
+    python fake_azure.py --port 9443 --certfile cert.pem --keyfile key.pem --groups 10,100,1000,5000
+
+MSAL only talks to https authorities so a certificate is needed for the token endpoints, and Netbox
+has to trust it (eg; by pointing REQUESTS_CA_BUNDLE at it). Graph can be served over plain http
+by running a second instance without a certificate.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+import argparse
+import base64
+import json
+import random
+import re
+import ssl
+import time
+import uuid
+
+TENANT_ID = '00000000-0000-0000-0000-0000000000aa'
+USER_DOMAIN = 'bench.example'
+USER_NAMESPACE = uuid.UUID('6ba7b811-9dad-11d1-80b4-00c04fd430c8')
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def group_id(index):
+    return str(uuid.UUID(int=index + 1))
+
+
+def user_index(identifier):
+    match = re.match(r'^user(\d+)', identifier or '')
+    return int(match.group(1)) if match else None
+
+
+def user_id(index):
+    return str(uuid.uuid5(USER_NAMESPACE, f'user{index}'))
+
+
+class FakeAzure:
+
+    def __init__(self, options):
+        self.options = options
+        self.group_counts = [int(count) for count in options.groups.split(',')]
+        self.user_ids = {}
+        self.users_delta_served = False
+        self.groups_delta_served = False
+
+    def user(self, index):
+        upn = f'user{index}@{USER_DOMAIN}'
+        self.user_ids[user_id(index)] = index
+        return {
+            'id': user_id(index),
+            'userPrincipalName': upn,
+            'mail': upn,
+            'givenName': 'Bench',
+            'surname': f'User {index}',
+            'displayName': f'Bench User {index}',
+        }
+
+    def lookup_user(self, identifier):
+        if identifier in self.user_ids:
+            return self.user_ids[identifier]
+        return user_index(identifier)
+
+    def groups_for(self, index):
+        return [
+            {'id': group_id(number), 'displayName': f'bench-group-{number}'}
+            for number in range(self.group_counts[index % len(self.group_counts)])
+        ]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def azure(self):
+        return self.server.azure
+
+    def log_message(self, format, *args):
+        if self.azure.options.verbose:
+            super().log_message(format, *args)
+
+    def base_url(self):
+        scheme = 'https' if isinstance(self.connection, ssl.SSLSocket) else 'http'
+        return f"{scheme}://{self.headers.get('Host')}"
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self.dispatch('GET', self.read_body())
+
+    def do_POST(self):
+        self.dispatch('POST', self.read_body())
+
+    def dispatch(self, method, body):
+        options = self.azure.options
+        url = urlparse(self.path)
+        is_graph = url.path.startswith('/v1.0/')
+        latency = options.graph_latency if is_graph else options.token_latency
+        if latency:
+            time.sleep(latency / 1000)
+        if is_graph and options.throttle_rate and random.random() < options.throttle_rate:
+            self.send_json(429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': str(options.retry_after)})
+            return
+        status, response = self.route(method, url, body)
+        self.send_json(status, response)
+
+    def route(self, method, url, body):
+        path = url.path
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if path.endswith('/.well-known/openid-configuration'):
+            return 200, self.openid_configuration()
+        if path.endswith('/discovery/instance'):
+            return 200, {'tenant_discovery_endpoint': query.get('authorization_endpoint', ''), 'metadata': []}
+        if path.endswith('/oauth2/v2.0/token') and method == 'POST':
+            return self.token(parse_qs(body.decode()))
+        if path.endswith('/discovery/v2.0/keys'):
+            return 200, {'keys': []}
+        if path == '/v1.0/$batch' and method == 'POST':
+            return 200, self.batch(json.loads(body or b'{}'))
+        return self.graph(method, path, query, body)
+
+    def openid_configuration(self):
+        base = f'{self.base_url()}/{TENANT_ID}'
+        return {
+            'issuer': f'{base}/v2.0',
+            'authorization_endpoint': f'{base}/oauth2/v2.0/authorize',
+            'token_endpoint': f'{base}/oauth2/v2.0/token',
+            'jwks_uri': f'{base}/discovery/v2.0/keys',
+            'response_types_supported': ['code', 'id_token', 'code id_token'],
+        }
+
+    def token(self, form):
+        client_id = form.get('client_id', ['bench'])[0]
+        grant_type = form.get('grant_type', [''])[0]
+        now = int(time.time())
+        if grant_type == 'client_credentials':
+            return 200, {'token_type': 'Bearer', 'expires_in': 3599, 'access_token': f'app-{now}'}
+        code = form.get('code', [''])[0]
+        index = user_index(code)
+        if index is None:
+            return 400, {'error': 'invalid_grant', 'error_description': 'Unknown authorization code'}
+        user = self.azure.user(index)
+        claims = {
+            'aud': client_id,
+            'iss': f'{self.base_url()}/{TENANT_ID}/v2.0',
+            'iat': now,
+            'nbf': now,
+            'exp': now + 3600,
+            'oid': user['id'],
+            'tid': TENANT_ID,
+            'sub': user['id'],
+            'name': user['displayName'],
+            'preferred_username': user['userPrincipalName'],
+            'email': user['mail'],
+            'given_name': user['givenName'],
+            'family_name': user['surname'],
+        }
+        if self.azure.options.group_claims:
+            groups = self.azure.groups_for(index)
+            if len(groups) > 200:
+                claims['hasgroups'] = True
+            else:
+                claims['groups'] = [group['id'] for group in groups]
+        _, _, nonce = code.partition('.')
+        if nonce:
+            claims['nonce'] = nonce
+        return 200, {
+            'token_type': 'Bearer',
+            'scope': form.get('scope', [''])[0],
+            'expires_in': 3599,
+            'access_token': f'user-{index}-{now}',
+            'refresh_token': f'refresh-{index}-{now}',
+            'id_token': f"{b64({'alg': 'RS256', 'typ': 'JWT'})}.{b64(claims)}.bench",
+            'client_info': b64({'uid': user['id'], 'utid': TENANT_ID}),
+        }
+
+    def batch(self, body):
+        responses = []
+        for request in body.get('requests', []):
+            url = urlparse(request['url'])
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            payload = json.dumps(request.get('body', {})).encode()
+            status, response = self.graph(request.get('method', 'GET'), f'/v1.0{url.path}', query, payload)
+            responses.append({'id': request['id'], 'status': status, 'body': response})
+        return {'responses': responses}
+
+    def graph(self, method, path, query, body):
+        azure = self.azure
+        match = re.match(r'^/v1\.0/users/([^/]+)/memberOf$', path)
+        if match:
+            index = azure.lookup_user(match.group(1))
+            if index is None:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            groups = azure.groups_for(index)
+            top = int(query.get('$top', 100))
+            skip = int(query.get('$skiptoken', 0))
+            page = {'value': groups[skip:skip + top]}
+            if skip + top < len(groups):
+                next_query = dict(query, **{'$skiptoken': skip + top})
+                page['@odata.nextLink'] = f'{self.base_url()}{path}?{urlencode(next_query, safe="$,")}'
+            return 200, page
+        match = re.match(r'^/v1\.0/users/([^/]+)/checkMemberGroups$', path)
+        if match and method == 'POST':
+            index = azure.lookup_user(match.group(1))
+            member_of = {group['id'] for group in azure.groups_for(index)} if index is not None else set()
+            requested = json.loads(body or b'{}').get('groupIds', [])
+            return 200, {'value': [group for group in requested if group in member_of]}
+        match = re.match(r'^/v1\.0/users/([^/]+)$', path)
+        if match and match.group(1) != 'delta':
+            index = azure.lookup_user(match.group(1))
+            if index is None:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            return 200, azure.user(index)
+        if path == '/v1.0/directoryObjects/getByIds' and method == 'POST':
+            ids = json.loads(body or b'{}').get('ids', [])
+            values = []
+            for object_id in ids:
+                if object_id in azure.user_ids:
+                    values.append(azure.user(azure.user_ids[object_id]))
+                elif object_id.startswith('00000000-0000-0000-0000-'):
+                    number = uuid.UUID(object_id).int - 1
+                    values.append({'id': object_id, 'displayName': f'bench-group-{number}'})
+            return 200, {'value': values}
+        if path == '/v1.0/users/delta':
+            return 200, self.users_delta(query)
+        if path == '/v1.0/groups/delta':
+            return 200, self.groups_delta(query)
+        return 404, {'error': {'code': 'NotFound', 'message': f'{method} {path} is not faked'}}
+
+    def users_delta(self, query):
+        if 'deltatoken' in query:
+            return {'value': [], '@odata.deltaLink': f'{self.base_url()}/v1.0/users/delta?deltatoken=1'}
+        return {
+            'value': [self.azure.user(index) for index in range(self.azure.options.users)],
+            '@odata.deltaLink': f'{self.base_url()}/v1.0/users/delta?deltatoken=1',
+        }
+
+    def groups_delta(self, query):
+        if 'deltatoken' in query:
+            return {'value': [], '@odata.deltaLink': f'{self.base_url()}/v1.0/groups/delta?deltatoken=1'}
+        members = {}
+        for index in range(self.azure.options.users):
+            self.azure.user(index)
+            for group in self.azure.groups_for(index):
+                members.setdefault(group['id'], []).append(
+                    {'@odata.type': '#microsoft.graph.user', 'id': user_id(index)}
+                )
+        return {
+            'value': [
+                {'id': gid, 'displayName': f'bench-group-{uuid.UUID(gid).int - 1}', 'members@delta': entries}
+                for gid, entries in members.items()
+            ],
+            '@odata.deltaLink': f'{self.base_url()}/v1.0/groups/delta?deltatoken=1',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=9443)
+    parser.add_argument('--certfile', help="Serve over https using this certificate")
+    parser.add_argument('--keyfile')
+    parser.add_argument('--groups', default='10', help="Comma separated group counts, assigned to users in turn")
+    parser.add_argument('--users', type=int, default=100, help="How many users the delta endpoints return")
+    parser.add_argument('--token-latency', type=float, default=0, help="Milliseconds added to token requests")
+    parser.add_argument('--graph-latency', type=float, default=0, help="Milliseconds added to Graph requests")
+    parser.add_argument('--throttle-rate', type=float, default=0, help="Fraction of Graph requests answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After sent with throttled responses")
+    parser.add_argument('--group-claims', action='store_true', help="Put group ids in the id token")
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args()
+
+    server = ThreadingHTTPServer((options.host, options.port), Handler)
+    server.daemon_threads = True
+    server.azure = FakeAzure(options)
+    if options.certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(options.certfile, options.keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    print(f"Fake Azure AD listening on {options.host}:{options.port} (tenant {TENANT_ID})", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Checks that syncing a user's groups doesn't get more expensive as Netbox accumulates groups.
+
+Runs the plugin's group sync directly, with MS Graph left out entirely, against synthetic datasets:
+Netbox pre-loaded with each of --existing unrelated groups, and a user in each of --memberships
+Azure AD groups. Every combination is measured for
+
+    first    a new user synced into all of their groups
+    rebuild  a resync of the same groups with no membership fingerprint cached
+    cached   a resync of the same groups with the fingerprint cached
+    changed  a resync after the user left one group and joined another
+
+recording database queries, wall time and peak Python memory. Everything happens inside a
+transaction that is rolled back at the end. Run it from Netbox's project directory:
+
+    cd /opt/netbox/netbox && python /opt/netbox/netbox_plugin_azuread/develop/benchmark/group_sync_budget.py
+
+It exits non-zero when a sync goes over its query budget, or when the queries or memory a sync needs
+change with the number of groups that already exist. Budgets assume PostgreSQL, as Netbox does.
+"""
+from statistics import median
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+PLUGIN = 'netbox_plugin_azuread'
+EXISTING_PREFIX = 'bench-existing-'
+AZURE_PREFIX = 'bench-azure-'
+PHASES = ('first', 'rebuild', 'cached', 'changed')
+# Queries each phase may make whatever the dataset, savepoints included
+QUERY_BUDGETS = {
+    'first': 10,
+    'rebuild': 4,
+    'cached': 0,
+    'changed': 10,
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+def setup_django(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    from django.conf import settings
+    # Only the membership sync itself is measured, so anything that would add Graph calls or
+    # hierarchy lookups is switched off
+    settings.PLUGINS_CONFIG[PLUGIN].update(
+        WARM_UP_ON_READY=False, NESTED_GROUPS=False, CHECK_MEMBER_GROUPS=False, METRICS_BACKEND=None
+    )
+    import django
+    django.setup()
+
+
+def azure_groups(count, offset=0):
+    from netbox_plugin_azuread.directory import AzureGroup
+    return [
+        AzureGroup(id=str(uuid.uuid5(uuid.NAMESPACE_OID, f'{AZURE_PREFIX}{index}')), name=f'{AZURE_PREFIX}{index}')
+        for index in range(offset, offset + count)
+    ]
+
+
+class Bench:
+
+    def __init__(self, repeat):
+        from django.contrib.auth.models import User
+        from django.core.cache import caches
+        from netbox_plugin_azuread import groups
+        from netbox_plugin_azuread.backends import AzureADRemoteUserBackend
+        from netbox_plugin_azuread.conf import PLUGIN_SETTINGS
+
+        self.repeat = repeat
+        self.backend = AzureADRemoteUserBackend()
+        self.cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+        self.user = User.objects.create(username=f'bench-{uuid.uuid4().hex}@example.com')
+        self.fingerprint_key = groups.MEMBERSHIP_KEY.format(self.user.pk)
+        # No AD_GROUP_FILTER, so the sync never tries to clean up the unrelated groups
+        groups._RESOLVER = groups.GroupResolver({}, [])
+
+    def close(self):
+        self.cache.delete(self.fingerprint_key)
+
+    def ensure_existing(self, count):
+        from django.contrib.auth.models import Group
+        have = Group.objects.filter(name__startswith=EXISTING_PREFIX).count()
+        Group.objects.bulk_create([Group(name=f'{EXISTING_PREFIX}{index}') for index in range(have, count)])
+
+    def prepare(self, phase, memberships):
+        # Puts the user in the state the phase starts from and returns the groups to sync them into
+        from django.contrib.auth.models import Group
+        self.cache.delete(self.fingerprint_key)
+        current = azure_groups(memberships)
+        if phase == 'first':
+            Group.objects.filter(name__startswith=AZURE_PREFIX).delete()
+            return current
+        self.backend._configure_access_groups(self.user, current)
+        if phase != 'cached':
+            self.cache.delete(self.fingerprint_key)
+        if phase == 'changed':
+            return current[1:] + azure_groups(1, offset=memberships)
+        return current
+
+    def sync(self, target, trace=False):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        if trace:
+            tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            self.backend._configure_access_groups(self.user, target)
+            elapsed = time.perf_counter() - started
+        peak = None
+        if trace:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return len(queries), elapsed, peak
+
+    def measure(self, phase, memberships):
+        # One traced run for queries and memory, then untraced runs for timing
+        query_count, _, peak = self.sync(self.prepare(phase, memberships), trace=True)
+        timings = []
+        for _ in range(self.repeat):
+            _, elapsed, _ = self.sync(self.prepare(phase, memberships))
+            timings.append(elapsed)
+        return {'queries': query_count, 'ms': median(timings) * 1000, 'peak_kib': peak / 1024}
+
+
+def run(options):
+    from django.db import transaction
+
+    results = []
+    try:
+        with transaction.atomic():
+            bench = Bench(options.repeat)
+            try:
+                for existing in sorted(options.existing):
+                    bench.ensure_existing(existing)
+                    for memberships in options.memberships:
+                        for phase in PHASES:
+                            result = bench.measure(phase, memberships)
+                            result.update(existing=existing, memberships=memberships, phase=phase)
+                            results.append(result)
+                            if not options.json:
+                                print(
+                                    f"{existing:>7} existing {memberships:>6} groups {phase:<8}"
+                                    f"{result['queries']:>4} queries {result['ms']:>9.1f}ms"
+                                    f"{result['peak_kib']:>10.0f}KiB peak"
+                                )
+            finally:
+                bench.close()
+            raise Rollback()
+    except Rollback:
+        pass
+    return results
+
+
+def check(results, options):
+    failures = []
+    for result in results:
+        budget = QUERY_BUDGETS[result['phase']]
+        if result['queries'] > budget:
+            failures.append(
+                f"{result['phase']} sync of {result['memberships']} groups with {result['existing']} existing "
+                f"made {result['queries']} queries, the budget is {budget}"
+            )
+
+    smallest, largest = min(options.existing), max(options.existing)
+    by_key = {(result['existing'], result['memberships'], result['phase']): result for result in results}
+    for memberships in options.memberships:
+        for phase in PHASES:
+            small, large = by_key[(smallest, memberships, phase)], by_key[(largest, memberships, phase)]
+            counts = {by_key[(existing, memberships, phase)]['queries'] for existing in options.existing}
+            if len(counts) > 1:
+                failures.append(
+                    f"{phase} sync of {memberships} groups made {', '.join(map(str, sorted(counts)))} queries "
+                    f"depending on how many groups already existed"
+                )
+            growth = large['peak_kib'] - small['peak_kib']
+            if growth > options.max_memory_growth:
+                failures.append(
+                    f"{phase} sync of {memberships} groups peaked {growth:.0f}KiB higher with {largest} "
+                    f"existing groups than with {smallest}"
+                )
+            if options.max_time_ratio and small['ms'] and large['ms'] / small['ms'] > options.max_time_ratio:
+                failures.append(
+                    f"{phase} sync of {memberships} groups took {large['ms'] / small['ms']:.1f}x as long with "
+                    f"{largest} existing groups as with {smallest}"
+                )
+    return failures
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--existing', type=sizes, default=[10, 1000, 20000],
+                        help="Comma separated numbers of unrelated groups already in Netbox")
+    parser.add_argument('--memberships', type=sizes, default=[1, 10, 100, 1000, 5000],
+                        help="Comma separated numbers of Azure AD groups the user is in")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per measurement, the median is reported")
+    parser.add_argument('--max-memory-growth', type=float, default=2048,
+                        help="KiB a sync's peak memory may grow by between the smallest and largest --existing")
+    parser.add_argument('--max-time-ratio', type=float, default=0,
+                        help="Fail if a sync slows down by more than this between the smallest and largest "
+                             "--existing. Timings are noisy so this is off by default")
+    parser.add_argument('--settings', default='netbox.settings')
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    options = parser.parse_args()
+
+    setup_django(options.settings)
+    results = run(options)
+    failures = check(results, options)
+
+    if options.json:
+        print(json.dumps({'results': results, 'failures': failures}, indent=2))
+    else:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        print(f"{len(results)} measurements, {len(failures)} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Measures what the plugin adds to Netbox's startup.
+
+Runs django.setup() (and, by default, loads the URLconf the way system checks and the first request
+do) in fresh interpreters with `-X importtime`, then reports how long setup took and how much of that
+was spent importing the plugin and whatever it pulled in. Run it from Netbox's project directory:
+
+    cd /opt/netbox/netbox && python /opt/netbox/netbox_plugin_azuread/develop/benchmark/import_time.py --runs 5
+
+Netbox's configuration is measured as it is, WARM_UP_ON_READY included. The warm up only starts
+with a process's first request, so MSAL and requests showing up as loaded after setup means something
+else imports them too early.
+"""
+from statistics import median
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+PLUGIN = 'netbox_plugin_azuread'
+# Dependencies that only a login should need, reported if anything in the plugin imports them
+HEAVY_MODULES = ('msal', 'requests', 'httpx')
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+SETUP = """
+import sys
+import time
+started = time.perf_counter()
+import django
+django.setup()
+if {urls!r}:
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+print('setup_seconds', time.perf_counter() - started)
+print('loaded', ' '.join(sorted(name for name in sys.modules if name.split('.')[0] in {heavy!r})))
+"""
+
+
+class ImportNode:
+
+    def __init__(self, name, depth, cumulative_us):
+        self.name = name
+        self.depth = depth
+        self.cumulative_us = cumulative_us
+        self.children = []
+
+
+def parse_import_times(output):
+    # -X importtime prints each module after everything it imported, indented by depth
+    stack = []
+    for line in output.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        node = ImportNode(match.group(4), len(match.group(3)) // 2, int(match.group(2)))
+        while stack and stack[-1].depth > node.depth:
+            node.children.insert(0, stack.pop())
+        stack.append(node)
+    return stack
+
+
+def plugin_imports(roots):
+    # The outermost plugin modules, whose cumulative time already covers everything beneath them
+    found = []
+    pending = list(roots)
+    while pending:
+        node = pending.pop()
+        if node.name.split('.')[0] == PLUGIN:
+            found.append(node)
+        else:
+            pending.extend(node.children)
+    return found
+
+
+def heavy_imports(node, via=None):
+    via = via or node.name
+    for child in node.children:
+        if child.name.split('.')[0] in HEAVY_MODULES:
+            yield child.name, child.cumulative_us, via
+        else:
+            yield from heavy_imports(child, via if child.name.split('.')[0] != PLUGIN else child.name)
+
+
+def measure(options):
+    code = SETUP.format(urls=not options.skip_urls, heavy=HEAVY_MODULES)
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=options.settings)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True, text=True, check=False
+    )
+    if result.returncode:
+        raise SystemExit(f"django.setup() failed:\n{result.stderr[-2000:]}")
+    values = dict(line.split(' ', 1) for line in result.stdout.splitlines() if ' ' in line)
+    plugin_nodes = plugin_imports(parse_import_times(result.stderr))
+    return {
+        'setup_ms': float(values['setup_seconds']) * 1000,
+        'plugin_ms': sum(node.cumulative_us for node in plugin_nodes) / 1000,
+        'plugin_modules': {node.name: node.cumulative_us / 1000 for node in plugin_nodes},
+        'heavy_imports': [
+            {'module': name, 'ms': cumulative / 1000, 'via': via}
+            for node in plugin_nodes
+            for name, cumulative, via in heavy_imports(node)
+        ],
+        'loaded': values.get('loaded', '').split(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to start, the median is reported")
+    parser.add_argument('--settings', default='netbox.settings')
+    parser.add_argument('--skip-urls', action='store_true', help="Only run django.setup(), not the URLconf")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    options = parser.parse_args()
+
+    runs = [measure(options) for _ in range(options.runs)]
+    last = runs[-1]
+    results = {
+        'runs': options.runs,
+        'setup_ms': median(run['setup_ms'] for run in runs),
+        'plugin_ms': median(run['plugin_ms'] for run in runs),
+        'plugin_modules': last['plugin_modules'],
+        'heavy_imports': last['heavy_imports'],
+        'loaded_after_setup': last['loaded'],
+    }
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+    share = results['plugin_ms'] / results['setup_ms'] * 100 if results['setup_ms'] else 0
+    print(f"django.setup(): {results['setup_ms']:.0f}ms median over {options.runs} runs")
+    print(f"Plugin imports: {results['plugin_ms']:.1f}ms ({share:.1f}% of setup)")
+    for name, ms in sorted(results['plugin_modules'].items(), key=lambda item: -item[1]):
+        print(f"  {name}: {ms:.1f}ms")
+    for heavy in results['heavy_imports']:
+        print(f"  {heavy['module']} imported by {heavy['via']}: {heavy['ms']:.1f}ms")
+    print(f"Loaded after setup: {', '.join(results['loaded_after_setup']) or 'none of ' + ', '.join(HEAVY_MODULES)}")
+
+
+if __name__ == '__main__':
+    main()
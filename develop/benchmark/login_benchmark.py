@@ -0,0 +1,186 @@
+"""
+Drives concurrent Azure AD logins through a running Netbox and reports how long they took.
+
+Netbox has to be configured against fake_azure.py so that authorization codes like `user42.<nonce>`
+are accepted. Each login loads the plugin's login page, pulls the state and nonce out of the Azure AD
+link and then calls the reply URL the same way the browser would after signing in. --login-url and
+--reply-url have to match the plugin's LOGIN_URL and REPLY_URL, as the login state cookie is only sent
+to the reply URL's path. A login only counts if it ends in a redirect to --next with a session cookie set.
+
+    python login_benchmark.py --netbox-url http://localhost:8000 --users 200 --concurrency 20
+
+When Netbox has METRICS_ENABLED, the plugin's metrics are read before and after the run to report
+time spent per login phase and database queries per group sync.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urljoin, urlparse
+import argparse
+import json
+import re
+import statistics
+import time
+import urllib.request
+
+AUTH_URL_PATTERN = re.compile(r'href="([^"]*[?&]state=[^"]*)"')
+METRIC_PATTERN = re.compile(r'^(netbox_azuread_[a-z_]+)(?:\{([^}]*)\})? ([0-9.e+-]+)$')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def login(options, index):
+    cookies = CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies), NoRedirect())
+    started = time.perf_counter()
+    login_url = f"{options.login_url}?{urlencode({'next': options.next})}"
+    page = opener.open(login_url, timeout=options.timeout).read().decode()
+    match = AUTH_URL_PATTERN.search(page)
+    if not match:
+        raise RuntimeError("No Azure AD link was found on the login page")
+    auth_query = parse_qs(urlparse(unescape(match.group(1))).query)
+    state, nonce = auth_query['state'][0], auth_query['nonce'][0]
+    authorize_started = time.perf_counter()
+    query = urlencode({'code': f'user{index}.{nonce}', 'state': state})
+    try:
+        response = opener.open(f'{options.reply_url}?{query}', timeout=options.timeout)
+        status, location = response.status, response.headers.get('Location', '')
+    except HTTPError as ex:
+        status, location = ex.code, ex.headers.get('Location', '')
+    finished = time.perf_counter()
+    # Every failure redirects too, to LOGIN_URL, so only the way back to next with a session counts
+    expected = urljoin(options.reply_url, options.next)
+    has_session = any(cookie.name == options.session_cookie and cookie.value for cookie in cookies)
+    if status != 302 or urljoin(options.reply_url, location) != expected or not has_session:
+        raise RuntimeError(f"Login for user{index} ended with {status} to {location or 'nowhere'}"
+                           f"{'' if has_session else ' without a session'}")
+    return finished - started, finished - authorize_started
+
+
+def read_metrics(options):
+    if not options.metrics_url:
+        return {}
+    samples = {}
+    body = urllib.request.urlopen(options.metrics_url, timeout=options.timeout).read().decode()
+    for line in body.splitlines():
+        match = METRIC_PATTERN.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return samples
+
+
+def summarise_metrics(before, after):
+    delta = {key: value - before.get(key, 0) for key, value in after.items()}
+    phases = {}
+    for (name, labels), value in delta.items():
+        phase = re.search(r'phase="([^"]+)"', labels)
+        if name == 'netbox_azuread_login_phase_seconds_sum' and phase:
+            count = delta.get(('netbox_azuread_login_phase_seconds_count', labels), 0)
+            if count:
+                phases[phase.group(1)] = {'count': int(count), 'mean_ms': value / count * 1000}
+    syncs = delta.get(('netbox_azuread_group_sync_queries_count', ''), 0)
+    queries = delta.get(('netbox_azuread_group_sync_queries_sum', ''), 0)
+    retries = {
+        re.search(r'reason="([^"]+)"', labels).group(1): int(value)
+        for (name, labels), value in delta.items()
+        if name == 'netbox_azuread_graph_retries_total' and value
+    }
+    return {
+        'phases': phases,
+        'group_syncs': int(syncs),
+        'queries_per_sync': queries / syncs if syncs else 0,
+        'graph_retries': retries,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--netbox-url', default='http://localhost:8000')
+    parser.add_argument('--login-url', help="The plugin's LOGIN_URL, defaults to /login/ on --netbox-url")
+    parser.add_argument('--reply-url', help="The plugin's REPLY_URL, defaults to /complete/ on --netbox-url")
+    parser.add_argument('--next', default='/', help="Where logins should end up")
+    parser.add_argument('--session-cookie', default='sessionid', help="Netbox's SESSION_COOKIE_NAME")
+    parser.add_argument('--metrics-url', help="Netbox's /metrics endpoint, eg; http://localhost:8000/metrics")
+    parser.add_argument('--users', type=int, default=100, help="How many distinct users log in")
+    parser.add_argument('--rounds', type=int, default=1, help="How many times each user logs in")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    options = parser.parse_args()
+    options.login_url = options.login_url or f'{options.netbox_url}/login/'
+    options.reply_url = options.reply_url or f'{options.netbox_url}/complete/'
+
+    logins = [index for _ in range(options.rounds) for index in range(options.users)]
+    before = read_metrics(options)
+    flow, authorize, errors = [], [], []
+
+    def run(index):
+        try:
+            total, callback = login(options, index)
+            flow.append(total)
+            authorize.append(callback)
+        except Exception as ex:
+            errors.append(str(ex))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+        list(pool.map(run, logins))
+    elapsed = time.perf_counter() - started
+
+    results = {
+        'logins': len(logins),
+        'errors': len(errors),
+        'concurrency': options.concurrency,
+        'elapsed_s': elapsed,
+        'throughput_per_s': len(flow) / elapsed if elapsed else 0,
+        'authorize_ms': {
+            'p50': percentile(authorize, 50) * 1000,
+            'p95': percentile(authorize, 95) * 1000,
+            'p99': percentile(authorize, 99) * 1000,
+            'mean': statistics.mean(authorize) * 1000 if authorize else 0,
+        },
+        'login_flow_ms': {
+            'p50': percentile(flow, 50) * 1000,
+            'p95': percentile(flow, 95) * 1000,
+            'p99': percentile(flow, 99) * 1000,
+        },
+    }
+    if options.metrics_url:
+        results['metrics'] = summarise_metrics(before, read_metrics(options))
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['logins']} logins, {results['errors']} errors, {options.concurrency} concurrent")
+        print(f"Throughput: {results['throughput_per_s']:.1f} logins/s over {elapsed:.1f}s")
+        for name in ('authorize_ms', 'login_flow_ms'):
+            stats = results[name]
+            print(f"{name[:-3]}: p50 {stats['p50']:.0f}ms, p95 {stats['p95']:.0f}ms, p99 {stats['p99']:.0f}ms")
+        metrics = results.get('metrics')
+        if metrics:
+            for phase, stats in sorted(metrics['phases'].items()):
+                print(f"  {phase}: {stats['mean_ms']:.1f}ms mean over {stats['count']}")
+            print(f"Group syncs: {metrics['group_syncs']}, {metrics['queries_per_sync']:.1f} queries each")
+            if metrics['graph_retries']:
+                print(f"Graph retries: {metrics['graph_retries']}")
+    for error in sorted(set(errors))[:10]:
+        print(f"Error: {error}")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -230,7 +230,9 @@ PLUGINS_CONFIG = {
         'AUTHORITY': environ.get("AUTHORITY"),
         'LOGIN_URL': 'http://localhost:8000/login/',
         'REPLY_URL': 'http://localhost:8000/complete/',
-        'SCOPES': ['https://graph.microsoft.com/.default']
+        'SCOPES': ['https://graph.microsoft.com/.default'],
+        'GRAPH_URL': environ.get('GRAPH_URL', 'https://graph.microsoft.com/v1.0'),
+        'VALIDATE_AUTHORITY': environ.get('VALIDATE_AUTHORITY', 'True').lower() == 'true',
     }
 }
 
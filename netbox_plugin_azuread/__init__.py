@@ -1,6 +1,10 @@
+from importlib.util import find_spec
 import logging
 import os
+import threading
 
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
 from extras.plugins import PluginConfig
 
 with open(
@@ -9,10 +13,41 @@ with open(
     VERSION = file.read().strip()
 
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-logging.basicConfig(level=LOGLEVEL)
 
 LOGGER = logging.getLogger("netbox_plugin_azuread")
-LOGGER.info("Initialising Netbox AzureAD plugin")
+
+# Settings that turn on a feature needing an optional dependency, with the module and extra it comes from
+OPTIONAL_DEPENDENCIES = (
+    ('GRAPH_ASYNC', 'httpx', 'async'),
+    ('API_AUTHENTICATION', 'jwt', 'api'),
+)
+
+
+def check_dependencies(plugin_settings):
+    # Only checks the modules can be found, without importing them, so startup stays as quick as before
+    for setting, module, extra in OPTIONAL_DEPENDENCIES:
+        if plugin_settings.get(setting) and find_spec(module) is None:
+            raise ImproperlyConfigured(
+                f"{setting} requires {module}, install it with `pip install netbox-plugin-azuread[{extra}]`"
+            )
+
+
+def configure_logging():
+    # The one place the plugin sets up logging, instead of each module calling basicConfig on import
+    logging.basicConfig(level=LOGLEVEL)
+    LOGGER.info("Initialising Netbox AzureAD plugin")
+
+
+def _warm_up():
+    from .clients import warm_up
+    warm_up()
+
+
+def warm_up_on_first_request(sender, **kwargs):
+    # Only processes serving requests get here, so management commands and rq workers never load MSAL
+    # or call Azure AD. The first request doesn't wait on it either, as it runs in the background
+    request_started.disconnect(warm_up_on_first_request)
+    threading.Thread(target=_warm_up, name='azuread-warm-up', daemon=True).start()
 
 
 class NetboxAzureADConfig(PluginConfig):
@@ -31,10 +66,69 @@ class NetboxAzureADConfig(PluginConfig):
     default_settings = {
         'LOGIN_URL': '/plugins/azuread/login/',
         'REPLY_URL': '/plugins/azuread/complete/',
+        'LOGIN_STATE_MAX_AGE': 600,
         'SCOPES': ['https://graph.microsoft.com/.default'],
-        'AD_GROUP_MAP': [],
+        'VALIDATE_AUTHORITY': True,
+        'AUTHORITY_CONNECT_TIMEOUT': 3.05,
+        'AUTHORITY_READ_TIMEOUT': 10,
+        'AD_GROUP_MAP': {},
         'AD_GROUP_FILTER': [],
+        'CACHE_ALIAS': 'default',
+        'APP_TOKEN_REFRESH_MARGIN': 300,
+        'TOKEN_CACHE_STORE': 'netbox_plugin_azuread.tokens.CacheTokenStore',
+        'TOKEN_CACHE_TIMEOUT': 86400,
+        'METADATA_CACHE_TTL': 86400,
+        'METADATA_STALE_TTL': 604800,
+        'WARM_UP_ON_READY': True,
+        'METRICS_BACKEND': None,
+        'GRAPH_URL': 'https://graph.microsoft.com/v1.0',
+        'GRAPH_POOL_SIZE': 10,
+        'GRAPH_CONNECT_TIMEOUT': 3.05,
+        'GRAPH_READ_TIMEOUT': 10,
+        'GRAPH_MAX_RETRIES': 3,
+        'GRAPH_BACKOFF_FACTOR': 0.5,
+        'GRAPH_MAX_RETRY_AFTER': 30,
+        'GRAPH_PAGE_SIZE': 999,
+        'GRAPH_ASYNC': False,
+        'GRAPH_BREAKER_THRESHOLD': 5,
+        'GRAPH_BREAKER_RESET_TIMEOUT': 30,
+        'USE_TOKEN_CLAIMS': False,
+        'GROUP_NAME_CACHE_TTL': 86400,
+        'MEMBERSHIP_FINGERPRINT_TTL': 86400,
+        'GROUP_SYNC_TTL': 0,
+        'DEFERRED_GROUP_SYNC': False,
+        'GROUP_SYNC_QUEUE': 'default',
+        'GROUP_SYNC_FIRST_LOGIN_ONLY': False,
+        'NESTED_GROUPS': False,
+        'CHECK_MEMBER_GROUPS': False,
+        'LOGIN_COALESCE_TIMEOUT': None,
+        'DEBUG_PAYLOAD_SAMPLE_RATE': 0,
+        'API_AUTHENTICATION': False,
+        'API_ALLOW_APP_TOKENS': False,
+        'API_AUDIENCES': [],
+        'API_ISSUERS': [],
+        'API_KEY_REFRESH_INTERVAL': 300,
+        'API_TOKEN_CACHE_SIZE': 1024,
+        'API_CLOCK_SKEW': 60,
     }
 
+    def ready(self):
+        super().ready()
+        configure_logging()
+        # Compile the group settings up front so a bad AD_GROUP_MAP fails at startup rather than mid-login
+        from .conf import PLUGIN_SETTINGS
+        from .groups import load_resolver
+        check_dependencies(PLUGIN_SETTINGS)
+        load_resolver()
+        # checkMemberGroups is transitive where memberOf isn't, which is easy to miss
+        transitive_checks = PLUGIN_SETTINGS.get('CHECK_MEMBER_GROUPS') and PLUGIN_SETTINGS.get('AD_GROUP_FILTER')
+        if transitive_checks and not PLUGIN_SETTINGS.get('NESTED_GROUPS'):
+            LOGGER.warning("CHECK_MEMBER_GROUPS counts nested group memberships even though NESTED_GROUPS is off")
+        if PLUGIN_SETTINGS.get('WARM_UP_ON_READY'):
+            request_started.connect(warm_up_on_first_request)
+        if PLUGIN_SETTINGS.get('API_AUTHENTICATION'):
+            from .authentication import register_api_authentication
+            register_api_authentication()
+
 
 config = NetboxAzureADConfig
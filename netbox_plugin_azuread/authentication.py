@@ -0,0 +1,277 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework.authentication import BaseAuthentication, get_authorization_header
+from rest_framework.exceptions import AuthenticationFailed
+
+from .clients import MetadataCachingHttpClient
+from .conf import PLUGIN_SETTINGS
+from .directory import AzureUser
+from .exceptions import AccountConflict
+from .groups import get_resolver
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+AUTHENTICATION_CLASS = 'netbox_plugin_azuread.authentication.AzureADTokenAuthentication'
+SIGNING_ALGORITHMS = ['RS256']
+V1_ISSUER = 'https://sts.windows.net/{}/'
+
+
+class SigningKeys:
+    # Azure AD's token signing keys, parsed once per worker. The key set itself is shared between
+    # workers through the metadata cache. A token signed with a key we don't know about is how a key
+    # rotation shows up, so that forces a fresh copy, at most once every API_KEY_REFRESH_INTERVAL.
+    # Requests go through MetadataCachingHttpClient so they're bound by the AUTHORITY_*_TIMEOUT settings
+
+    def __init__(self):
+        self.http = MetadataCachingHttpClient()
+        self.keys = {}
+        self.issuers = frozenset()
+        self.loaded_at = 0
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def get(self, key_id):
+        now = time.time()
+        ttl = PLUGIN_SETTINGS['METADATA_CACHE_TTL']
+        key = self.keys.get(key_id)
+        if key is not None and now - self.loaded_at < ttl:
+            return key
+        # A caller that already has a usable key doesn't queue up behind a reload in another thread
+        if not self.lock.acquire(blocking=key is None):
+            return key
+        try:
+            if not self.keys or now - self.loaded_at >= ttl:
+                self._reload(refresh=False)
+            if key_id not in self.keys and now - self.refreshed_at >= PLUGIN_SETTINGS['API_KEY_REFRESH_INTERVAL']:
+                LOGGER.info("Token signed with unknown key %s, refreshing Azure AD's signing keys", key_id)
+                self.refreshed_at = now
+                self._reload(refresh=True)
+            return self.keys.get(key_id)
+        finally:
+            self.lock.release()
+
+    def _reload(self, refresh):
+        try:
+            self._load(refresh)
+        except Exception as ex:
+            if not self.keys:
+                raise
+            # Keep serving the keys we already have and try again after API_KEY_REFRESH_INTERVAL
+            LOGGER.warning("Failed to reload Azure AD's signing keys, keeping the ones loaded earlier: %s", ex)
+            retry_at = time.time() - PLUGIN_SETTINGS['METADATA_CACHE_TTL'] + PLUGIN_SETTINGS['API_KEY_REFRESH_INTERVAL']
+            self.loaded_at = max(self.loaded_at, retry_at)
+
+    def _load(self, refresh):
+        from jwt.algorithms import RSAAlgorithm
+
+        metadata = self.http.get(
+            f"{PLUGIN_SETTINGS['AUTHORITY'].rstrip('/')}/v2.0/.well-known/openid-configuration"
+        ).json()
+        fetch = self.http.refresh if refresh else self.http.get
+        response = fetch(metadata['jwks_uri'])
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            if jwk.get('kty') == 'RSA' and jwk.get('kid'):
+                keys[jwk['kid']] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+        self.keys = keys
+        self.issuers = default_issuers(metadata.get('issuer', ''))
+        self.loaded_at = time.time()
+
+
+def default_issuers(issuer):
+    # Access tokens are issued as v1 or v2 depending on the app registration, so both issuers are accepted.
+    # Multi-tenant authorities only give a template, and accepting every tenant has to be asked for explicitly
+    if not issuer or '{tenantid}' in issuer:
+        return frozenset()
+    tenant_id = issuer.rstrip('/').split('/')[-2]
+    return frozenset([issuer, V1_ISSUER.format(tenant_id)])
+
+
+class ValidatedTokens:
+    # An LRU of tokens that have already been validated, so repeat calls with the same token
+    # skip signature checks and the group sync. Entries only live as long as the token does
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        key = hashlib.sha256(token.encode()).digest()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def add(self, token, user_id, expires_at):
+        key = hashlib.sha256(token.encode()).digest()
+        with self.lock:
+            self.entries[key] = (user_id, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > PLUGIN_SETTINGS['API_TOKEN_CACHE_SIZE']:
+                self.entries.popitem(last=False)
+
+    def discard(self, token):
+        with self.lock:
+            self.entries.pop(hashlib.sha256(token.encode()).digest(), None)
+
+
+_SIGNING_KEYS = SigningKeys()
+_VALIDATED_TOKENS = ValidatedTokens()
+
+
+def validate_token(token):
+    import jwt
+
+    try:
+        key_id = jwt.get_unverified_header(token).get('kid')
+    except jwt.InvalidTokenError as ex:
+        raise AuthenticationFailed("Invalid Azure AD token") from ex
+    if not key_id:
+        raise AuthenticationFailed("Invalid Azure AD token")
+    try:
+        key = _SIGNING_KEYS.get(key_id)
+    except Exception as ex:
+        LOGGER.error("Failed to load Azure AD's signing keys: %s", ex)
+        raise AuthenticationFailed("Unable to validate Azure AD tokens right now") from ex
+    if key is None:
+        raise AuthenticationFailed("Azure AD token was signed with an unknown key")
+
+    client_id = PLUGIN_SETTINGS['CLIENT_ID']
+    try:
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=SIGNING_ALGORITHMS,
+            audience=PLUGIN_SETTINGS['API_AUDIENCES'] or [client_id, f'api://{client_id}'],
+            leeway=PLUGIN_SETTINGS['API_CLOCK_SKEW'],
+            options={'require': ['exp', 'iss', 'aud']}
+        )
+    except jwt.InvalidTokenError as ex:
+        LOGGER.debug("Rejected an Azure AD token: %s", ex)
+        raise AuthenticationFailed("Invalid Azure AD token") from ex
+    if claims['iss'] not in (PLUGIN_SETTINGS['API_ISSUERS'] or _SIGNING_KEYS.issuers):
+        LOGGER.debug("Rejected an Azure AD token from %s", claims['iss'])
+        raise AuthenticationFailed("Azure AD token was issued by an untrusted tenant")
+    return claims
+
+
+def is_app_token(claims):
+    # Tokens from the client credentials flow act as the app itself rather than a signed in user.
+    # idtyp is an optional claim but only delegated tokens, issued to a user, carry scopes
+    return claims.get('idtyp') == 'app' or 'scp' not in claims
+
+
+def check_app_token(claims):
+    # Any app in the tenant can get a client credentials token for this app's audience, so apps are only
+    # let in when that's been asked for, and only with an app role that AD_GROUP_MAP gives permissions to
+    if not PLUGIN_SETTINGS['API_ALLOW_APP_TOKENS']:
+        raise AuthenticationFailed("Azure AD tokens issued to apps aren't accepted")
+    resolver = get_resolver()
+    if not any(role in resolver.roles for role in claims.get('roles', [])):
+        LOGGER.info("Rejected an Azure AD token for app %s without a mapped app role",
+                    claims.get('azp') or claims.get('appid'))
+        raise AuthenticationFailed("Azure AD token has no app role that Netbox recognises")
+
+
+def token_username(claims, app_only):
+    if app_only:
+        return claims.get('azp') or claims.get('appid')
+    return claims.get('preferred_username') or claims.get('upn') or claims.get('unique_name')
+
+
+class AzureADTokenAuthentication(BaseAuthentication):
+    # Authenticates `Authorization: Bearer <token>` requests to the REST API with Azure AD access tokens
+    # issued for this app. Tokens are validated locally, and users and their groups are set up the same
+    # way as an interactive login the first time each token is seen
+    keyword = 'Bearer'
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed("Invalid Azure AD token header")
+        try:
+            token = auth[1].decode()
+        except UnicodeError as ex:
+            raise AuthenticationFailed("Invalid Azure AD token header") from ex
+
+        user_id = _VALIDATED_TOKENS.get(token)
+        if user_id is not None:
+            user = get_user_model().objects.filter(pk=user_id).first()
+            if user is None:
+                _VALIDATED_TOKENS.discard(token)
+                raise AuthenticationFailed("User no longer exists")
+        else:
+            claims = validate_token(token)
+            user = self.user_for_claims(claims)
+            # Users whose groups couldn't be synced are checked again on their next call
+            if not getattr(user, 'azuread_permissions_stale', False):
+                _VALIDATED_TOKENS.add(token, user.pk, claims['exp'])
+        if not user.is_active:
+            raise AuthenticationFailed("User is inactive")
+        return user, None
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+    def user_for_claims(self, claims):
+        from .backends import AzureADRemoteUserBackend
+
+        app_only = is_app_token(claims)
+        if app_only:
+            check_app_token(claims)
+        username = token_username(claims, app_only)
+        if not username:
+            raise AuthenticationFailed("Azure AD token doesn't identify a user")
+        backend = AzureADRemoteUserBackend()
+        # Apps are linked by their service principal's object id just like users are
+        object_id = claims.get('oid')
+        try:
+            user = backend.find_user(object_id, username)
+        except AccountConflict as ex:
+            LOGGER.error("Rejected an Azure AD token for %s: %s", username, ex)
+            raise AuthenticationFailed("Azure AD token belongs to a different account") from ex
+        if user is None:
+            if not settings.REMOTE_AUTH_AUTO_CREATE_USER:
+                LOGGER.info("Rejected an Azure AD token for %s as REMOTE_AUTH_AUTO_CREATE_USER is off", username)
+                raise AuthenticationFailed("User doesn't exist")
+            user = backend.create_user(username, AzureUser(
+                id=object_id,
+                username=username,
+                email=claims.get('email') or '',
+                first_name=claims.get('given_name') or '',
+                last_name=claims.get('family_name') or ''
+            ), object_id)
+        elif not app_only:
+            backend.update_user(user, username, AzureUser.from_claims(claims))
+        return backend.sync_groups_from_token(user, claims, app_only)
+
+
+def register_api_authentication():
+    # Only Netbox's own API views are given the class, after whatever they already authenticate with so
+    # Netbox's `Token` API tokens keep working. Views that chose their own classes, and other apps' views,
+    # are left alone, and so is DRF's APIView. The base classes are imported here as they aren't ready
+    # to import any earlier
+    try:
+        from netbox.api.views import APIRootView, ModelViewSet, StatusView
+    except ImportError as ex:
+        LOGGER.warning("Unable to enable Azure AD tokens on Netbox's API, add %s to REST_FRAMEWORK "
+                       "instead: %s", AUTHENTICATION_CLASS, ex)
+        return
+    for view in (APIRootView, ModelViewSet, StatusView):
+        if AzureADTokenAuthentication not in view.authentication_classes:
+            view.authentication_classes = (*view.authentication_classes, AzureADTokenAuthentication)
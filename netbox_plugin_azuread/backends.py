@@ -1,21 +1,52 @@
 from pprint import pformat
 import logging
-import os
+import random
+import time
+import uuid
 
 from django.contrib.auth import login as auth_login, get_user_model
 from django.contrib.auth.base_user import BaseUserManager
-from django.contrib.auth.models import User, Group
-from django.conf import settings
-import msal
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.module_loading import import_string
 from netbox.authentication import RemoteUserBackend
-import requests
 
-PLUGIN_SETTINGS = settings.PLUGINS_CONFIG["netbox_plugin_azuread"]
+from .clients import get_msal_client
+from .conf import PLUGIN_SETTINGS
+from .directory import AzureGroup, AzureUser
+from .exceptions import AccountConflict, GraphError
+from .groups import (
+    OBJECT_ID_PATTERN, READ_ONLY_GROUP, delete_unfiltered_groups, get_last_sync, get_resolver,
+    membership_fingerprint, reconcile_user_groups, record_sync
+)
+from .hierarchy import get_hierarchy
+from .metrics import get_metrics
+from .models import AzureADUser
+from .singleflight import single_flight
+from .tokens import acquire_app_token, evict_expired_tokens
 
-LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-logging.basicConfig(level=LOGLEVEL)
 LOGGER = logging.getLogger("netbox_plugin_azuread")
 
+PROFILE_FIELDS = ('email', 'first_name', 'last_name')
+
+
+def log_payload(description, payload):
+    # Claims and Graph payloads can run to thousands of groups, so they're only formatted for
+    # a sample of logins and only when debug logging is actually on
+    sample_rate = PLUGIN_SETTINGS['DEBUG_PAYLOAD_SAMPLE_RATE']
+    if sample_rate and LOGGER.isEnabledFor(logging.DEBUG) and random.random() < sample_rate:
+        LOGGER.debug("%s: %s", description, pformat(payload))
+
+
+def coalesce_timeout():
+    # Waiting on another login is only worth it for about as long as one Graph request can take,
+    # after that it's quicker for each login to go ahead on its own
+    timeout = PLUGIN_SETTINGS['LOGIN_COALESCE_TIMEOUT']
+    if timeout is None:
+        timeout = PLUGIN_SETTINGS['GRAPH_CONNECT_TIMEOUT'] + PLUGIN_SETTINGS['GRAPH_READ_TIMEOUT']
+    return timeout
+
 
 class AzureADRemoteUserBackend(RemoteUserBackend):
 
@@ -25,145 +56,416 @@ class AzureADRemoteUserBackend(RemoteUserBackend):
     def configure_user(self, request, user):
         return super().configure_user(request, user)
 
-    def acquire_user_token(self, request, redirect_uri):
+    def acquire_user_token(self, request, redirect_uri, nonce=None, code_verifier=None):
         cache = self._load_cache(request)
-        client = self._create_msal_client(cache=cache)
-        result = client.acquire_token_by_authorization_code(
-            request.GET['code'],
-            scopes=PLUGIN_SETTINGS['SCOPES'],
-            redirect_uri=redirect_uri
-        )
+        client = self._create_msal_client()
+        kwargs = {'data': {'code_verifier': code_verifier}} if code_verifier else {}
+        try:
+            result = client.acquire_token_by_authorization_code(
+                request.GET['code'],
+                scopes=PLUGIN_SETTINGS['SCOPES'],
+                redirect_uri=redirect_uri,
+                nonce=nonce,
+                **kwargs
+            )
+        except (RuntimeError, ValueError) as ex:
+            # MSAL raises when the id token fails validation, such as a nonce that doesn't match
+            LOGGER.warning("Rejected the id token returned by Azure AD: %s", ex)
+            return None
+        self._move_user_tokens(client, cache, result)
         self._save_cache(request, cache)
         return result
 
     def acquire_client_token(self):
-        client = self._create_msal_client()
-        result = client.acquire_token_for_client(
-            scopes=PLUGIN_SETTINGS['SCOPES']
-        )
-        return result.get('access_token')
+        with get_metrics().phase('app_token'):
+            client = self._create_msal_client()
+            return acquire_app_token(
+                client,
+                scopes=PLUGIN_SETTINGS['SCOPES'],
+                cache=caches[PLUGIN_SETTINGS['CACHE_ALIAS']],
+                refresh_margin=PLUGIN_SETTINGS['APP_TOKEN_REFRESH_MARGIN']
+            )
 
     def login(self, request, user):
         auth_login(request, user, backend='netbox_plugin_azuread.backends.AzureADRemoteUserBackend')
 
     def retrieve_user(self, auth_result):
-        access_token = self.acquire_client_token()
-        LOGGER.debug(f"Received an access token for the user: {access_token}")
-        LOGGER.debug(f"Claims map looks as follows: {pformat(auth_result)}")
         claims = auth_result.get('id_token_claims')
-        try:
-            user = get_user_model().objects.get(username=claims.get('preferred_username'))
-            LOGGER.debug(f"Retrieved user: {pformat(user)}")
-        except Exception as ex:
-            LOGGER.debug(f"Failed to find a user. Attempting to create a user from scratch: {ex}")
-            user = self._create_user_from_claims(claims, access_token)
-        self._configure_access_groups(user, access_token) # groups change over time so we check each login
+        log_payload("Claims map looks as follows", claims)
+        # Double clicks, several tabs and login storms all land here for the same user at once.
+        # Only one of them talks to Graph and syncs groups, the rest wait for it. What's shared is
+        # the user's pk, and every caller loads its own copy of the user to log in with
+        result = single_flight(
+            f"retrieve_user:{claims.get('oid') or claims.get('preferred_username')}",
+            lambda: self._retrieve_user_pk(claims),
+            cache=caches[PLUGIN_SETTINGS['CACHE_ALIAS']],
+            timeout=coalesce_timeout()
+        )
+        if result is None:
+            return None
+        user_pk, stale = result
+        user = get_user_model().objects.filter(pk=user_pk).first()
+        if user is not None and stale:
+            user.azuread_permissions_stale = True
         return user
 
-    def _create_user_from_claims(self, claims, access_token):
+    def _retrieve_user_pk(self, claims):
+        user = self._retrieve_user(claims)
+        if user is None:
+            return None
+        return user.pk, getattr(user, 'azuread_permissions_stale', False)
+
+    def _retrieve_user(self, claims):
         username = claims.get('preferred_username')
-        LOGGER.debug(f"Creating a user with the username {username}")
-        profile = self._get_user_profile(username, access_token)
+        object_id = claims.get('oid')
+        try:
+            user = self.find_user(object_id, username)
+        except AccountConflict as ex:
+            LOGGER.error("Refusing to log in %s: %s", username, ex)
+            return None
+
+        if user is not None:
+            LOGGER.debug("Retrieved user %s", username)
+            self.update_user(user, username, AzureUser.from_claims(claims))
+            if PLUGIN_SETTINGS['GROUP_SYNC_FIRST_LOGIN_ONLY']:
+                LOGGER.debug("Groups for %s are only synced on their first login", username)
+                return user
+            if PLUGIN_SETTINGS['GROUP_SYNC_TTL']:
+                last_sync = get_last_sync(caches[PLUGIN_SETTINGS['CACHE_ALIAS']], user)
+                if last_sync and time.time() - last_sync['synced_at'] < PLUGIN_SETTINGS['GROUP_SYNC_TTL']:
+                    LOGGER.debug("Groups for %s were synced recently, skipping MS Graph", username)
+                    return user
+            if PLUGIN_SETTINGS['DEFERRED_GROUP_SYNC']:
+                # Log in with the permissions from the last sync and let a worker catch up
+                from .jobs import enqueue_group_sync
+                enqueue_group_sync(user, claims)
+                return user
+            return self.sync_groups(user, claims) # groups change over time so we check each login
+
+        # New users have no permissions to fall back on so they're always synced straight away
+        try:
+            profile, azure_groups, app_roles = self._fetch_directory_data(claims, need_profile=True)
+        except GraphError as ex:
+            LOGGER.error("Unable to set up %s while MS Graph is unavailable: %s", username, ex)
+            return None
+        user = self.create_user(username, profile, object_id)
+        self._configure_access_groups(user, azure_groups, app_roles)
+        return user
+
+    def sync_groups(self, user, claims):
+        try:
+            _, azure_groups, app_roles = self._fetch_directory_data(claims, need_profile=False)
+        except GraphError as ex:
+            return self._keep_last_sync(user, ex)
+        return self._configure_access_groups(user, azure_groups, app_roles)
+
+    def sync_groups_from_token(self, user, claims, app_only=False):
+        # API access tokens bring their own groups and roles, MS Graph is only asked when the groups didn't fit.
+        # Apps have no memberOf to fall back on so they only get what's in the token
+        try:
+            _, azure_groups, app_roles = self._read_token_claims(claims)
+            if azure_groups is None:
+                azure_groups = [] if app_only else self._retrieve_user_groups(claims.get('oid'), self._get_access_token())
+        except GraphError as ex:
+            return self._keep_last_sync(user, ex)
+        return self._configure_access_groups(user, azure_groups, app_roles)
+
+    def _keep_last_sync(self, user, error):
+        # An empty or partial answer from Graph would strip the user's permissions, so the groups and
+        # flags from their last successful sync are left alone and the user is marked as stale instead
+        LOGGER.warning("MS Graph is unavailable, %s keeps the permissions from their last sync: %s",
+                       user.username, error)
+        get_metrics().stale_permissions()
+        user.azuread_permissions_stale = True
+        return user
+
+    def _fetch_directory_data(self, claims, need_profile):
+        # Graph is asked by object id when the token has one, which keeps working after a UPN rename.
+        # Returning users already have a profile so only their groups are fetched
+        user_id = claims.get('oid') or claims.get('preferred_username')
+        profile, azure_groups, app_roles = None, None, ()
+        if PLUGIN_SETTINGS['USE_TOKEN_CLAIMS']:
+            profile, azure_groups, app_roles = self._read_token_claims(claims)
+        if azure_groups is None and self._checks_member_groups():
+            access_token = self._get_access_token()
+            azure_groups = self._retrieve_user_groups(user_id, access_token)
+            if need_profile and profile is None:
+                profile = self._get_user_profile(user_id, access_token)
+        elif azure_groups is None and need_profile:
+            profile, azure_groups = self._retrieve_profile_and_groups(user_id, self._get_access_token())
+        elif azure_groups is None:
+            azure_groups = self._retrieve_user_groups(user_id, self._get_access_token())
+        elif need_profile and profile is None:
+            profile = self._get_user_profile(user_id, self._get_access_token())
+        return profile, azure_groups, app_roles
+
+    def _get_access_token(self):
+        if getattr(self, '_access_token', None) is None:
+            self._access_token = self.acquire_client_token()
+            LOGGER.debug("Received an access token for MS Graph")
+        return self._access_token
+
+    def _read_token_claims(self, claims):
+        # Returns None for the profile or the groups when the token can't supply them and Graph has to
+        if claims.get('hasgroups') or 'groups' in claims.get('_claim_names', {}):
+            LOGGER.debug("Token has a group overage claim, falling back to MS Graph")
+            azure_groups = None
+        elif 'groups' not in claims:
+            LOGGER.debug("Token has no groups claim, falling back to MS Graph")
+            azure_groups = None
+        else:
+            azure_groups = self._groups_from_claims(claims['groups'])
+        return AzureUser.from_claims(claims), azure_groups, claims.get('roles', [])
+
+    def _groups_from_claims(self, group_claims):
+        from .graph import get_group_names
+        group_ids = [group for group in group_claims if OBJECT_ID_PATTERN.match(group)]
+        names = get_group_names(
+            group_ids,
+            caches[PLUGIN_SETTINGS['CACHE_ALIAS']],
+            lambda: self._graph_client(self._get_access_token())
+        )
+        # Groups emitted as sAMAccountName or similar are already names rather than ids
+        return [
+            AzureGroup(id=group, name=names.get(group)) if OBJECT_ID_PATTERN.match(group)
+            else AzureGroup(id=None, name=group)
+            for group in group_claims
+        ]
+
+    def find_user(self, object_id, username):
+        # The object id never changes so it's tried first. Users from before the mapping existed are
+        # matched on their username once and linked, after which UPN renames no longer matter
+        if object_id:
+            link = AzureADUser.objects.select_related('user').filter(object_id=object_id).first()
+            if link is not None:
+                return link.user
+        user = get_user_model().objects.filter(username=username).first() if username else None
+        if user is not None and object_id:
+            link, created = AzureADUser.objects.get_or_create(user=user, defaults={'object_id': object_id})
+            if not created and link.object_id != uuid.UUID(object_id):
+                raise AccountConflict(f"{username} is already linked to Azure AD object {link.object_id}")
+            if created:
+                LOGGER.info("Linked %s to Azure AD object %s", username, object_id)
+        return user
+
+    def update_user(self, user, username, profile=None):
+        # Only what actually changed is written, which for most logins is nothing at all
+        changed = []
+        if username and user.username != username:
+            if get_user_model().objects.filter(username=username).exclude(pk=user.pk).exists():
+                LOGGER.warning("Unable to rename %s to %s as that username is taken", user.username, username)
+            else:
+                LOGGER.info("Renaming %s to %s to match Azure AD", user.username, username)
+                user.username = username
+                changed.append('username')
+        if profile is not None:
+            for field in PROFILE_FIELDS:
+                value = getattr(profile, field)
+                if getattr(user, field) != value:
+                    setattr(user, field, value)
+                    changed.append(field)
+        if changed:
+            user.save(update_fields=changed)
+        return changed
+
+    def create_user(self, username, profile, object_id=None):
+        LOGGER.debug("Creating a user with the username %s", username)
         password = BaseUserManager().make_random_password()
         user = User(
             username=username,
             password=password,
-            email=profile.get('mail', ''),
-            first_name=profile.get('givenName', ''),
-            last_name=profile.get('surname', '')
+            email=profile.email,
+            first_name=profile.first_name,
+            last_name=profile.last_name
         )
-        user.save()
+        with transaction.atomic():
+            user.save()
+            if object_id:
+                AzureADUser.objects.create(object_id=object_id, user=user)
         LOGGER.debug("New user created")
         return user
 
-    def _retrieve_user_groups(self, user_id, access_token):
-        LOGGER.debug(f"Attempting to retrieve groups for user with id {user_id}")
-        groups_url = f'https://graph.microsoft.com/v1.0/users/{user_id}/memberOf?$select=displayName,id'
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        r = requests.get(groups_url, headers=headers)
-        LOGGER.debug(f"Retrieved groups for {user_id} from MS Graph: {pformat(r.json())}")
-        return r.json().get('value', [])
-
-    def _configure_access_groups(self, user, access_token):
-        user_profile = self._get_user_profile(user.username, access_token)
-        user_id = user_profile.get('id')
-        azure_groups = self._retrieve_user_groups(user_id, access_token)
-        user.is_staff = False
-        user.is_superuser = False # Recheck user still has these permissions each time
-        # TODO: Remove user from all groups if no groups found in Azure
-        if azure_groups:
-            LOGGER.debug(f"This user is part of {len(azure_groups)} azure groups")
-            azure_group_names = [entry.get('displayName') for entry in azure_groups]
-            AD_GROUP_MAP = PLUGIN_SETTINGS.get('AD_GROUP_MAP', {})
-            AD_GROUP_FILTER = PLUGIN_SETTINGS.get('AD_GROUP_FILTER', [])
-            for group_name in azure_group_names:
-                if AD_GROUP_FILTER and group_name not in AD_GROUP_FILTER:
-                    LOGGER.debug(f"Skipping group creation for {group_name} due to AD_GROUP_FILTER")
-                    continue
-                group, _ = Group.objects.get_or_create(
-                    name=group_name
-                )
-                group.user_set.add(user)
-                if group_name in AD_GROUP_MAP.get('READ_ONLY', []):
-                    LOGGER.info(f"Delegated read only permission to f{user.email}")
-                    reader_group, _ = Group.objects.get_or_create(name='READ_ONLY')
-                    reader_group.user_set.add(user)
-                if group_name in AD_GROUP_MAP.get('STAFF', []):
-                    LOGGER.info(f"Delegated staff permission to {user.email}")
-                    user.is_staff = True
-                if group_name in AD_GROUP_MAP.get('SUPERUSER', []):
-                    LOGGER.info(f"Delegated superuser permission to {user.email}")
-                    user.is_superuser = True
-                    user.is_staff = True
-            for group in Group.objects.all():
-                if group.name not in azure_group_names:  # ensure that deleted groups are cleaned up
-                    LOGGER.info(f"Removed {user.email} from {group.name}")
-                    group.user_set.remove(user)
-                if AD_GROUP_FILTER and group.name not in AD_GROUP_FILTER:
-                    result, _ = Group.objects.filter(name=group.name).delete()
-                    if result:
-                        LOGGER.debug(f"Deleted {group.name} as it isn't defined in AD_GROUP_FILTER")
-        user.save() # it would be wasteful to save every time if there are say; 1000 admin groups configured
+    def _retrieve_profile_and_groups(self, username, access_token):
+        # Fetch the profile and the first page of groups in a single round trip, falling back to
+        # individual requests (which retry on their own) for any part of the batch that failed
+        client = self._graph_client(access_token)
+        with get_metrics().phase('graph_batch'):
+            responses = client.batch([
+                {'id': 'profile', 'method': 'GET', 'url': f'/users/{username}'},
+                {'id': 'groups', 'method': 'GET', 'url': self._member_of_path(username)},
+            ])
+        profile_response = responses.get('profile', {})
+        if profile_response.get('status') == 200:
+            log_payload(f"Retrieved profile for {username} from MS Graph", profile_response.get('body'))
+            profile = AzureUser.from_graph(profile_response.get('body', {}))
+        else:
+            profile = self._get_user_profile(username, access_token)
+        groups_response = responses.get('groups', {})
+        first_page = groups_response.get('body') if groups_response.get('status') == 200 else None
+        azure_groups = self._retrieve_user_groups(username, access_token, first_page=first_page)
+        return profile, azure_groups
+
+    def _graph_client(self, access_token):
+        # Imported here so requests isn't loaded until a login needs MS Graph
+        from .graph import GraphClient
+        return GraphClient(access_token)
+
+    def _member_of_path(self, user_id):
+        return f"/users/{user_id}/memberOf?$select=displayName,id&$top={PLUGIN_SETTINGS['GRAPH_PAGE_SIZE']}"
+
+    def _checks_member_groups(self):
+        return PLUGIN_SETTINGS['CHECK_MEMBER_GROUPS'] and bool(get_resolver().group_filter)
+
+    def _retrieve_user_groups(self, user_id, access_token, first_page=None):
+        if self._checks_member_groups():
+            return self._check_member_groups(user_id, access_token)
+        LOGGER.debug("Attempting to retrieve groups for user with id %s", user_id)
+        client = self._graph_client(access_token)
+        with get_metrics().phase('graph_groups'):
+            groups = [
+                AzureGroup.from_graph(entry)
+                for entry in client.iter_values(self._member_of_path(user_id), first_page=first_page)
+            ]
+        LOGGER.debug("Retrieved %d groups for %s from MS Graph", len(groups), user_id)
+        log_payload(f"Groups for {user_id}", groups)
+        return groups
+
+    def _check_member_groups(self, user_id, access_token):
+        # Only the groups in AD_GROUP_FILTER can grant anything so Graph is asked about those alone,
+        # keeping the cost of a login down to the size of the filter rather than the user's membership
+        from .graph import get_group_ids, get_group_names
+        resolver = get_resolver()
+        cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+        client = self._graph_client(access_token)
+        candidates = get_group_names(resolver.filter_ids, cache, lambda: client) if resolver.filter_ids else {}
+        if resolver.filter_names:
+            for name, group_ids in get_group_ids(resolver.filter_names, cache, lambda: client).items():
+                for group_id in group_ids:
+                    candidates[group_id] = name
+        if not candidates:
+            return []
+        with get_metrics().phase('graph_groups'):
+            member_of = client.check_member_groups(user_id, candidates)
+        LOGGER.debug("%s is in %d of the %d filtered groups", user_id, len(member_of), len(candidates))
+        return [AzureGroup(id=group_id, name=candidates.get(group_id)) for group_id in member_of]
+
+    def _configure_access_groups(self, user, azure_groups, app_roles=()):
+        # TODO: Remove user from all groups if no groups found in Azure. That's already the case with
+        # CHECK_MEMBER_GROUPS, where Graph is only asked about the filtered groups and fails with a GraphError
+        # rather than an empty answer, so finding none of them means the user is in none of them
+        if azure_groups and PLUGIN_SETTINGS['NESTED_GROUPS']:
+            azure_groups = get_hierarchy().expand(azure_groups)
+        resolution = None
+        if azure_groups or app_roles or self._checks_member_groups():
+            LOGGER.debug("This user is part of %d azure groups", len(azure_groups))
+            resolution = get_resolver().resolve(azure_groups, app_roles)
+        # Recheck user still has these permissions each time
+        is_staff = bool(resolution and resolution.is_staff)
+        is_superuser = bool(resolution and resolution.is_superuser)
+        flags_changed = (user.is_staff, user.is_superuser) != (is_staff, is_superuser)
+
+        cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+        fingerprint = membership_fingerprint(resolution)
+        last_sync = get_last_sync(cache, user)
+        unchanged = not flags_changed and last_sync is not None and last_sync['fingerprint'] == fingerprint
+        metrics = get_metrics()
+        metrics.cache_lookup('membership', unchanged)
+        if unchanged:
+            LOGGER.debug("Group membership for %s is unchanged since the last sync", user.username)
+            record_sync(cache, user, fingerprint, PLUGIN_SETTINGS['MEMBERSHIP_FINGERPRINT_TTL'])
+            return user
+
+        with metrics.phase('group_sync'), metrics.count_queries():
+            with transaction.atomic():
+                if resolution is not None:
+                    resolver = get_resolver()
+                    if resolution.extra_groups:
+                        LOGGER.info("Delegated read only permission to %s", user.email)
+                    if resolution.is_superuser:
+                        LOGGER.info("Delegated superuser permission to %s", user.email)
+                    elif resolution.is_staff:
+                        LOGGER.info("Delegated staff permission to %s", user.email)
+                    reconcile_user_groups(user, resolution.group_names)
+                    if resolver.group_filter and not resolver.filter_ids:
+                        # Netbox groups are named after display names so cleanup is only safe when the filter uses them too
+                        delete_unfiltered_groups(resolver.filter_names, keep=[READ_ONLY_GROUP])
+                if flags_changed:
+                    user.is_staff = is_staff
+                    user.is_superuser = is_superuser
+                    user.save(update_fields=['is_staff', 'is_superuser'])
+        record_sync(cache, user, fingerprint, PLUGIN_SETTINGS['MEMBERSHIP_FINGERPRINT_TTL'])
         return user
 
     def _get_user_profile(self, username, access_token):
-        LOGGER.debug(f"Retrieving user profile for {username}")
-        profile_url = f'https://graph.microsoft.com/v1.0/users/{username}'
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        r = requests.get(profile_url, headers=headers)
-        LOGGER.debug(f"Retrieved profile for {username} from MS Graph: {pformat(r.json())}")
-        return r.json()
-
-    def get_auth_url(self, redirect_url, state=None):
+        LOGGER.debug("Retrieving user profile for %s", username)
+        with get_metrics().phase('graph_profile'):
+            data = self._graph_client(access_token).get(f'/users/{username}')
+        log_payload(f"Retrieved profile for {username} from MS Graph", data)
+        return AzureUser.from_graph(data)
+
+    def get_auth_url(self, redirect_url, state=None, nonce=None, code_challenge=None):
         client = self._create_msal_client()
+        kwargs = {'code_challenge': code_challenge, 'code_challenge_method': 'S256'} if code_challenge else {}
         auth_url = client.get_authorization_request_url(
             scopes=PLUGIN_SETTINGS["SCOPES"],
             state=state,
-            redirect_uri=redirect_url
+            redirect_uri=redirect_url,
+            nonce=nonce,
+            **kwargs
         )
-        LOGGER.debug(f"Generated auth url: {auth_url}")
+        LOGGER.debug("Generated auth url: %s", auth_url)
         return auth_url
 
+    def _token_store(self):
+        return import_string(PLUGIN_SETTINGS['TOKEN_CACHE_STORE'])(
+            cache=caches[PLUGIN_SETTINGS['CACHE_ALIAS']],
+            timeout=PLUGIN_SETTINGS['TOKEN_CACHE_TIMEOUT']
+        )
+
     def _load_cache(self, request):
+        import msal
         cache = msal.SerializableTokenCache()
-        if request.session.get('token_cache', False):
-            cache.deserialize(request.session['token_cache'])
+        key = request.session.get('token_cache_key')
+        if key:
+            serialized = self._token_store().load(key)
+            if serialized:
+                cache.deserialize(serialized)
         return cache
 
     def _save_cache(self, request, cache):
-        if cache.has_state_changed:
-            request.session['token_cache'] = cache.serialize()
+        # Only a short key lives in the session, the tokens themselves are stored by home account id
+        if not cache.has_state_changed:
+            return
+        import msal
+        accounts = cache.find(msal.TokenCache.CredentialType.ACCOUNT)
+        if not accounts:
+            return
+        evict_expired_tokens(cache, msal.TokenCache.CredentialType)
+        key = accounts[-1]['home_account_id']
+        self._token_store().save(key, cache.serialize())
+        request.session['token_cache_key'] = key
+        request.session.pop('token_cache', None)
+
+    def _move_user_tokens(self, client, cache, result):
+        # The pooled client is shared by every request in this worker so user tokens
+        # are copied into the per-session cache and then dropped from the shared one
+        if 'access_token' not in result:
+            return
+        import msal
+        cache.add({
+            'client_id': client.client_id,
+            'scope': PLUGIN_SETTINGS['SCOPES'],
+            'token_endpoint': client.authority.token_endpoint,
+            'response': result,
+        })
+        for account in cache.find(msal.TokenCache.CredentialType.ACCOUNT):
+            for pooled_account in client.get_accounts():
+                if pooled_account.get('home_account_id') == account.get('home_account_id'):
+                    client.remove_account(pooled_account)
 
-    def _create_msal_client(self, cache=None):
-        return msal.ConfidentialClientApplication(
+    def _create_msal_client(self):
+        return get_msal_client(
             client_id=PLUGIN_SETTINGS["CLIENT_ID"],
             client_credential=PLUGIN_SETTINGS["CLIENT_SECRET"],
-            authority=PLUGIN_SETTINGS["AUTHORITY"],
-            token_cache=cache
+            authority=PLUGIN_SETTINGS["AUTHORITY"]
         )
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from .conf import PLUGIN_SETTINGS
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    # Closed: requests go through and consecutive failures are counted. Open: requests fail straight
+    # away until GRAPH_BREAKER_RESET_TIMEOUT has passed. Half open: a single probe is let through,
+    # closing the circuit if it succeeds and opening it again if it doesn't. State is per worker
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not PLUGIN_SETTINGS['GRAPH_BREAKER_THRESHOLD']:
+            return True
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= PLUGIN_SETTINGS['GRAPH_BREAKER_RESET_TIMEOUT']:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                LOGGER.info("%s is answering again, closing its circuit", self.name)
+                self._set_state(CLOSED)
+
+    def release_probe(self):
+        # For requests that failed before MS Graph had a chance to answer, which say nothing about its health
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        threshold = PLUGIN_SETTINGS['GRAPH_BREAKER_THRESHOLD']
+        if not threshold:
+            return
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= threshold):
+                LOGGER.warning("%s failed %d times in a row, opening its circuit", self.name, self.failures)
+                self.opened_at = time.time()
+                self._set_state(OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        get_metrics().circuit_state(self.name, state)
+
+
+GRAPH_BREAKER = CircuitBreaker('graph')
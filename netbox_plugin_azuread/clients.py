@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .conf import PLUGIN_SETTINGS
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+METADATA_KEY = 'netbox_plugin_azuread:metadata:{}'
+METADATA_PATHS = ('/.well-known/openid-configuration', '/common/discovery/instance', '/discovery/v2.0/keys')
+METADATA_REFRESH_LOCK_TIMEOUT = 30
+
+
+class CachedResponse:
+
+    def __init__(self, url, entry):
+        self.url = url
+        self.status_code = entry['status_code']
+        self.text = entry['text']
+        self.headers = entry['headers']
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+def build_session():
+    # requests has no session wide timeout, so the adapter gives one to every request sent without
+    # its own, including the discovery and token requests MSAL makes through this client
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    default_timeout = (PLUGIN_SETTINGS['AUTHORITY_CONNECT_TIMEOUT'], PLUGIN_SETTINGS['AUTHORITY_READ_TIMEOUT'])
+
+    class TimeoutHTTPAdapter(HTTPAdapter):
+
+        def send(self, request, timeout=None, **kwargs):
+            return super().send(request, timeout=timeout or default_timeout, **kwargs)
+
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class MetadataCachingHttpClient:
+    # Serves MSAL's OpenID and instance discovery requests, as well as Azure AD's signing keys, from the
+    # shared cache so that a fresh worker doesn't have to go to Azure AD, and so logins keep working through
+    # a short metadata outage. Everything else, including token requests, goes straight through
+
+    def __init__(self, session=None):
+        self.session = session or build_session()
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        if not any(path in url for path in METADATA_PATHS):
+            return self.session.get(url, params=params, **kwargs)
+        cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+        key = self._key(url, params)
+        try:
+            entry = cache.get(key)
+        except Exception as ex:
+            LOGGER.debug("Failed to read cached metadata for %s: %s", url, ex)
+            return self.session.get(url, params=params, **kwargs)
+        get_metrics().cache_lookup('metadata', entry is not None)
+        if entry is None:
+            return self._fetch(cache, key, url, params, **kwargs)
+        if time.time() - entry['fetched_at'] >= PLUGIN_SETTINGS['METADATA_CACHE_TTL']:
+            # Stale entries are still served while a single worker refreshes them in the background
+            if cache.add(f'{key}:lock', 1, METADATA_REFRESH_LOCK_TIMEOUT):
+                threading.Thread(
+                    target=self._refresh, args=(cache, key, url, params), kwargs=kwargs, daemon=True
+                ).start()
+        return CachedResponse(url, entry)
+
+    def refresh(self, url, params=None, **kwargs):
+        # Skips the cache and replaces whatever was there, eg; when signing keys have rotated early
+        return self._fetch(caches[PLUGIN_SETTINGS['CACHE_ALIAS']], self._key(url, params), url, params, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def _key(self, url, params):
+        return METADATA_KEY.format(hashlib.sha256(f"{url}|{json.dumps(params, sort_keys=True)}".encode()).hexdigest())
+
+    def _fetch(self, cache, key, url, params, **kwargs):
+        response = self.session.get(url, params=params, **kwargs)
+        if 200 <= response.status_code < 300:
+            try:
+                cache.set(key, {
+                    'status_code': response.status_code,
+                    'text': response.text,
+                    'headers': dict(response.headers),
+                    'fetched_at': time.time(),
+                }, timeout=PLUGIN_SETTINGS['METADATA_CACHE_TTL'] + PLUGIN_SETTINGS['METADATA_STALE_TTL'])
+            except Exception as ex:
+                LOGGER.debug("Failed to cache metadata from %s: %s", url, ex)
+        return response
+
+    def _refresh(self, cache, key, url, params, **kwargs):
+        try:
+            self._fetch(cache, key, url, params, **kwargs)
+        except Exception as ex:
+            LOGGER.warning("Failed to refresh metadata from %s, serving the cached copy: %s", url, ex)
+        finally:
+            cache.delete(f'{key}:lock')
+
+
+# MSAL performs authority and instance discovery when a client is constructed
+# so we hold onto one client per (authority, client_id) for the life of the worker
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_msal_client(client_id, client_credential, authority):
+    key = (authority, client_id)
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    # msal and requests are only loaded once a login needs them, keeping them out of worker startup
+    import msal
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            LOGGER.debug("Creating MSAL client for %s against %s", client_id, authority)
+            client = msal.ConfidentialClientApplication(
+                client_id=client_id,
+                client_credential=client_credential,
+                authority=authority,
+                validate_authority=PLUGIN_SETTINGS['VALIDATE_AUTHORITY'],
+                http_client=MetadataCachingHttpClient()
+            )
+            _CLIENTS[key] = client
+    return client
+
+
+def warm_up():
+    # Loads the discovery metadata ahead of the first login, which otherwise pays for it
+    try:
+        get_msal_client(
+            client_id=PLUGIN_SETTINGS["CLIENT_ID"],
+            client_credential=PLUGIN_SETTINGS["CLIENT_SECRET"],
+            authority=PLUGIN_SETTINGS["AUTHORITY"]
+        )
+    except Exception as ex:
+        LOGGER.warning("Failed to warm up the MSAL client: %s", ex)
+
+
+def invalidate_msal_clients():
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+    LOGGER.debug("Invalidated pooled MSAL clients")
+
+
+@receiver(setting_changed)
+def _invalidate_on_setting_changed(sender, setting, **kwargs):
+    if setting == 'PLUGINS_CONFIG':
+        invalidate_msal_clients()
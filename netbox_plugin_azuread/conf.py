@@ -0,0 +1,36 @@
+from collections.abc import Mapping
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+PLUGIN_NAME = 'netbox_plugin_azuread'
+
+
+@lru_cache(maxsize=None)
+def get_plugin_settings():
+    return settings.PLUGINS_CONFIG[PLUGIN_NAME]
+
+
+class LazyPluginSettings(Mapping):
+    # Modules keep indexing PLUGIN_SETTINGS as before but nothing is read from Django's
+    # settings until the first lookup, so importing the plugin never needs them configured
+
+    def __getitem__(self, key):
+        return get_plugin_settings()[key]
+
+    def __iter__(self):
+        return iter(get_plugin_settings())
+
+    def __len__(self):
+        return len(get_plugin_settings())
+
+
+PLUGIN_SETTINGS = LazyPluginSettings()
+
+
+@receiver(setting_changed)
+def _clear_on_setting_changed(sender, setting, **kwargs):
+    if setting == 'PLUGINS_CONFIG':
+        get_plugin_settings.cache_clear()
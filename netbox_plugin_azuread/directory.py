@@ -0,0 +1,48 @@
+from dataclasses import dataclass
+
+# Graph responses are parsed once into these and the raw payloads dropped, so a user in thousands
+# of groups costs a couple of short strings per group rather than a dict with every selected field
+
+
+@dataclass(frozen=True)
+class AzureUser:
+    __slots__ = ('id', 'username', 'email', 'first_name', 'last_name')
+    id: str
+    username: str
+    email: str
+    first_name: str
+    last_name: str
+
+    @classmethod
+    def from_graph(cls, data):
+        return cls(
+            id=data.get('id'),
+            username=data.get('userPrincipalName'),
+            email=data.get('mail') or '',
+            first_name=data.get('givenName') or '',
+            last_name=data.get('surname') or ''
+        )
+
+    @classmethod
+    def from_claims(cls, claims):
+        # Returns None unless the token carries everything Graph would have given us
+        if any(claims.get(claim) is None for claim in ('email', 'given_name', 'family_name')):
+            return None
+        return cls(
+            id=claims.get('oid'),
+            username=claims.get('preferred_username'),
+            email=claims['email'],
+            first_name=claims['given_name'],
+            last_name=claims['family_name']
+        )
+
+
+@dataclass(frozen=True)
+class AzureGroup:
+    __slots__ = ('id', 'name')
+    id: str
+    name: str
+
+    @classmethod
+    def from_graph(cls, data):
+        return cls(id=data.get('id'), name=data.get('displayName'))
@@ -0,0 +1,16 @@
+class GraphError(Exception):
+    # MS Graph couldn't answer, either after exhausting retries or with an error response
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GraphUnavailable(GraphError):
+    # The circuit breaker is open so the request was never sent
+    pass
+
+
+class AccountConflict(Exception):
+    # The Netbox user with this username is already linked to a different Azure AD object
+    pass
@@ -0,0 +1,265 @@
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .breaker import GRAPH_BREAKER
+from .conf import PLUGIN_SETTINGS
+from .exceptions import GraphError, GraphUnavailable
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+GET_BY_IDS_LIMIT = 1000
+CHECK_MEMBER_GROUPS_LIMIT = 20
+# Graph allows up to 15 values in an `in` filter
+FILTER_IN_LIMIT = 15
+GROUP_NAME_KEY = 'netbox_plugin_azuread:group_name:{}'
+GROUP_IDS_KEY = 'netbox_plugin_azuread:group_ids:{}'
+
+_SESSION = None
+_SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    global _SESSION, _SESSION_PID
+    # Connection pools can't be shared across a fork so each worker builds its own
+    if _SESSION is not None and _SESSION_PID == os.getpid():
+        return _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_PID != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=PLUGIN_SETTINGS['GRAPH_POOL_SIZE'], max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _SESSION = session
+            _SESSION_PID = os.getpid()
+    return _SESSION
+
+
+def backoff_delay(attempt):
+    return min(
+        PLUGIN_SETTINGS['GRAPH_BACKOFF_FACTOR'] * (2 ** attempt),
+        PLUGIN_SETTINGS['GRAPH_MAX_RETRY_AFTER']
+    )
+
+
+def retry_delay(response, attempt):
+    delay = _retry_after(response)
+    if delay is None:
+        return backoff_delay(attempt)
+    return min(delay, PLUGIN_SETTINGS['GRAPH_MAX_RETRY_AFTER'])
+
+
+def retry_reason(response):
+    return 'throttled' if response.status_code == 429 else 'server_error'
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def filter_by_names(names):
+    quoted = ', '.join("'{}'".format(name.replace("'", "''")) for name in names)
+    return f"/groups?$select=id,displayName&$filter={quote(f'displayName in ({quoted})')}"
+
+
+def parse_response(response):
+    if 200 <= response.status_code < 300:
+        return response.json()
+    try:
+        message = response.json().get('error', {}).get('message')
+    except ValueError:
+        message = None
+    raise GraphError(
+        f"MS Graph returned {response.status_code} for {response.url}: {message or 'no details'}",
+        status_code=response.status_code
+    )
+
+
+class GraphClient:
+
+    def __init__(self, access_token, session=None):
+        self.access_token = access_token
+        self.session = session or get_session()
+        self.headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        self.timeout = (PLUGIN_SETTINGS['GRAPH_CONNECT_TIMEOUT'], PLUGIN_SETTINGS['GRAPH_READ_TIMEOUT'])
+
+    def url(self, path):
+        if path.startswith('https://') or path.startswith('http://'):
+            return path
+        return f"{PLUGIN_SETTINGS['GRAPH_URL']}{path}"
+
+    def request(self, method, path, headers=None, **kwargs):
+        # Error responses are handed back as they are, but the breaker counts throttling, server errors
+        # and connection failures that outlast the retries, and stops sending anything while it's open
+        if not GRAPH_BREAKER.allow():
+            raise GraphUnavailable("MS Graph is unavailable, its circuit breaker is open")
+        try:
+            response = self._send(method, path, headers, **kwargs)
+        except requests.RequestException as ex:
+            GRAPH_BREAKER.record_failure()
+            raise GraphError(f"Failed to reach MS Graph: {ex}") from ex
+        except BaseException:
+            # Anything else still has to hand back a half open probe, or the circuit never closes again
+            GRAPH_BREAKER.release_probe()
+            raise
+        if response.status_code in RETRY_STATUSES:
+            GRAPH_BREAKER.record_failure()
+        else:
+            GRAPH_BREAKER.record_success()
+        return response
+
+    def _send(self, method, path, headers=None, **kwargs):
+        url = self.url(path)
+        headers = dict(self.headers, **headers) if headers else self.headers
+        max_retries = PLUGIN_SETTINGS['GRAPH_MAX_RETRIES']
+        metrics = get_metrics()
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt >= max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                metrics.graph_retry('connection')
+                LOGGER.debug("Graph request to %s failed (%s), retrying in %.2fs", url, ex, delay)
+            else:
+                metrics.graph_response(response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                    return response
+                delay = retry_delay(response, attempt)
+                metrics.graph_retry(retry_reason(response))
+                LOGGER.debug("Graph returned %s for %s, retrying in %.2fs", response.status_code, url, delay)
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return parse_response(self.request('GET', path, **kwargs))
+
+    def iter_pages(self, path, first_page=None, **kwargs):
+        page = first_page if first_page is not None else self.get(path, **kwargs)
+        while True:
+            yield page
+            next_link = page.get('@odata.nextLink')
+            if not next_link:
+                return
+            page = self.get(next_link, **kwargs)
+
+    def iter_values(self, path, first_page=None):
+        for page in self.iter_pages(path, first_page=first_page):
+            yield from page.get('value', [])
+
+    def batch(self, batch_requests):
+        # Graph accepts up to 20 requests per batch and answers them in any order
+        response = self.request('POST', '/$batch', json={'requests': batch_requests})
+        if not response.ok:
+            LOGGER.debug("Graph batch request failed with %s", response.status_code)
+            return {}
+        return {entry['id']: entry for entry in response.json().get('responses', [])}
+
+    def _fan_out(self, name, *args):
+        # With GRAPH_ASYNC, lookups that take several requests send them all at once rather than one after
+        # another. Imported here so httpx is only loaded when it's on
+        from . import graph_async
+        return graph_async.run(getattr(graph_async, name)(self.access_token, *args))
+
+    def get_by_ids(self, ids, types=None):
+        ids = list(ids)
+        if PLUGIN_SETTINGS['GRAPH_ASYNC'] and len(ids) > GET_BY_IDS_LIMIT:
+            yield from self._fan_out('get_by_ids', ids, types)
+            return
+        for start in range(0, len(ids), GET_BY_IDS_LIMIT):
+            body = {'ids': ids[start:start + GET_BY_IDS_LIMIT]}
+            if types:
+                body['types'] = types
+            yield from parse_response(self.request('POST', '/directoryObjects/getByIds', json=body)).get('value', [])
+
+    def check_member_groups(self, user_id, group_ids):
+        # Returns which of group_ids the user is in, nested memberships included, however many groups they're in overall
+        group_ids = list(group_ids)
+        if PLUGIN_SETTINGS['GRAPH_ASYNC'] and len(group_ids) > CHECK_MEMBER_GROUPS_LIMIT:
+            return self._fan_out('check_member_groups', user_id, group_ids)
+        member_of = []
+        for start in range(0, len(group_ids), CHECK_MEMBER_GROUPS_LIMIT):
+            body = {'groupIds': group_ids[start:start + CHECK_MEMBER_GROUPS_LIMIT]}
+            member_of.extend(parse_response(
+                self.request('POST', f'/users/{user_id}/checkMemberGroups', json=body)
+            ).get('value', []))
+        return member_of
+
+    def find_groups_by_name(self, names):
+        names = list(names)
+        if PLUGIN_SETTINGS['GRAPH_ASYNC'] and len(names) > FILTER_IN_LIMIT:
+            yield from self._fan_out('find_groups_by_name', names)
+            return
+        for start in range(0, len(names), FILTER_IN_LIMIT):
+            yield from self.iter_values(filter_by_names(names[start:start + FILTER_IN_LIMIT]))
+
+
+def _group_ids_key(name):
+    # Display names can contain anything, including characters some cache backends refuse in keys
+    return GROUP_IDS_KEY.format(hashlib.sha1(name.encode()).hexdigest())
+
+
+def get_group_ids(group_names, cache, get_client):
+    # The reverse of get_group_names, for groups configured by display name. Several groups can share
+    # a name so each maps to a list of ids, which is empty for names that don't match any group
+    keys = {_group_ids_key(name): name for name in group_names}
+    ids = {keys[key]: group_ids for key, group_ids in cache.get_many(keys).items()}
+    missing = [name for name in keys.values() if name not in ids]
+    get_metrics().cache_lookup('group_id', not missing)
+    if missing:
+        found = {name: [] for name in missing}
+        for entry in get_client().find_groups_by_name(missing):
+            # Graph matches display names case insensitively, Netbox group names don't
+            if entry.get('displayName') in found:
+                found[entry['displayName']].append(entry['id'])
+        for name, group_ids in found.items():
+            if not group_ids:
+                LOGGER.warning("No Azure AD group is named %s", name)
+        cache.set_many(
+            {_group_ids_key(name): group_ids for name, group_ids in found.items()},
+            timeout=PLUGIN_SETTINGS['GROUP_NAME_CACHE_TTL']
+        )
+        ids.update(found)
+    return ids
+
+
+def get_group_names(group_ids, cache, get_client):
+    # Display names come from a shared cache with a single getByIds lookup for any ids that
+    # haven't been seen before. get_client is only called when Graph is actually needed
+    keys = {GROUP_NAME_KEY.format(group_id): group_id for group_id in group_ids}
+    names = {keys[key]: name for key, name in cache.get_many(keys).items()}
+    missing = [group_id for group_id in keys.values() if group_id not in names]
+    get_metrics().cache_lookup('group_name', not missing)
+    if missing:
+        found = {entry['id']: entry.get('displayName') for entry in get_client().get_by_ids(missing, types=['group'])}
+        cache.set_many(
+            {GROUP_NAME_KEY.format(group_id): name for group_id, name in found.items() if name},
+            timeout=PLUGIN_SETTINGS['GROUP_NAME_CACHE_TTL']
+        )
+        names.update(found)
+    return names
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import threading
+
+import httpx
+
+from .breaker import GRAPH_BREAKER
+from .conf import PLUGIN_SETTINGS
+from .exceptions import GraphError, GraphUnavailable
+from .graph import (
+    CHECK_MEMBER_GROUPS_LIMIT, FILTER_IN_LIMIT, GET_BY_IDS_LIMIT, RETRY_STATUSES, backoff_delay, filter_by_names,
+    parse_response, retry_delay, retry_reason
+)
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+# An AsyncClient is tied to the event loop it was created on, so each worker runs one long-lived
+# loop in a background thread that GraphClient blocks on through run()
+_LOOP = None
+_LOOP_PID = None
+_HTTP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_loop():
+    global _LOOP, _LOOP_PID, _HTTP
+    if _LOOP is not None and _LOOP_PID == os.getpid():
+        return _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP_PID != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='azuread-graph', daemon=True)
+            thread.start()
+            _HTTP = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    PLUGIN_SETTINGS['GRAPH_READ_TIMEOUT'],
+                    connect=PLUGIN_SETTINGS['GRAPH_CONNECT_TIMEOUT']
+                ),
+                limits=httpx.Limits(
+                    max_connections=PLUGIN_SETTINGS['GRAPH_POOL_SIZE'],
+                    max_keepalive_connections=PLUGIN_SETTINGS['GRAPH_POOL_SIZE']
+                )
+            )
+            _LOOP = loop
+            _LOOP_PID = os.getpid()
+    return _LOOP
+
+
+def run(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+class AsyncGraphClient:
+
+    def __init__(self, access_token):
+        _get_loop()
+        self.http = _HTTP
+        self.headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+
+    def url(self, path):
+        if path.startswith('https://') or path.startswith('http://'):
+            return path
+        return f"{PLUGIN_SETTINGS['GRAPH_URL']}{path}"
+
+    async def request(self, method, path, **kwargs):
+        if not GRAPH_BREAKER.allow():
+            raise GraphUnavailable("MS Graph is unavailable, its circuit breaker is open")
+        try:
+            response = await self._send(method, path, **kwargs)
+        except httpx.HTTPError as ex:
+            GRAPH_BREAKER.record_failure()
+            raise GraphError(f"Failed to reach MS Graph: {ex}") from ex
+        except BaseException:
+            # Including cancellation, which would otherwise leave a half open probe out forever
+            GRAPH_BREAKER.release_probe()
+            raise
+        if response.status_code in RETRY_STATUSES:
+            GRAPH_BREAKER.record_failure()
+        else:
+            GRAPH_BREAKER.record_success()
+        return response
+
+    async def _send(self, method, path, **kwargs):
+        url = self.url(path)
+        max_retries = PLUGIN_SETTINGS['GRAPH_MAX_RETRIES']
+        metrics = get_metrics()
+        attempt = 0
+        while True:
+            try:
+                response = await self.http.request(method, url, headers=self.headers, **kwargs)
+            except httpx.TransportError as ex:
+                if attempt >= max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                metrics.graph_retry('connection')
+                LOGGER.debug("Graph request to %s failed (%s), retrying in %.2fs", url, ex, delay)
+            else:
+                metrics.graph_response(response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                    return response
+                delay = retry_delay(response, attempt)
+                metrics.graph_retry(retry_reason(response))
+                LOGGER.debug("Graph returned %s for %s, retrying in %.2fs", response.status_code, url, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, path, **kwargs):
+        return parse_response(await self.request('GET', path, **kwargs))
+
+    async def post(self, path, body):
+        return parse_response(await self.request('POST', path, json=body))
+
+    async def get_all(self, path):
+        values = []
+        page = await self.get(path)
+        while True:
+            values.extend(page.get('value', []))
+            next_link = page.get('@odata.nextLink')
+            if not next_link:
+                return values
+            page = await self.get(next_link)
+
+
+async def _gather(coroutines):
+    # At most GRAPH_POOL_SIZE requests are in flight, the rest wait here rather than timing out on the pool
+    semaphore = asyncio.Semaphore(PLUGIN_SETTINGS['GRAPH_POOL_SIZE'])
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*map(limited, coroutines))
+
+
+def _chunks(values, size):
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+async def check_member_groups(access_token, user_id, group_ids):
+    client = AsyncGraphClient(access_token)
+    pages = await _gather(
+        client.post(f'/users/{user_id}/checkMemberGroups', {'groupIds': chunk})
+        for chunk in _chunks(list(group_ids), CHECK_MEMBER_GROUPS_LIMIT)
+    )
+    return [group_id for page in pages for group_id in page.get('value', [])]
+
+
+async def get_by_ids(access_token, ids, types=None):
+    client = AsyncGraphClient(access_token)
+    extra = {'types': types} if types else {}
+    pages = await _gather(
+        client.post('/directoryObjects/getByIds', dict(extra, ids=chunk))
+        for chunk in _chunks(list(ids), GET_BY_IDS_LIMIT)
+    )
+    return [entry for page in pages for entry in page.get('value', [])]
+
+
+async def find_groups_by_name(access_token, names):
+    client = AsyncGraphClient(access_token)
+    results = await _gather(
+        client.get_all(filter_by_names(chunk)) for chunk in _chunks(list(names), FILTER_IN_LIMIT)
+    )
+    return [entry for entries in results for entry in entries]
@@ -0,0 +1,147 @@
+from collections import namedtuple
+import hashlib
+from types import MappingProxyType
+import logging
+import re
+import time
+
+from django.contrib.auth.models import Group
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .conf import PLUGIN_SETTINGS
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+READ_ONLY_GROUP = 'READ_ONLY'
+STAFF_ROLE = 'STAFF'
+SUPERUSER_ROLE = 'SUPERUSER'
+ROLES = frozenset([READ_ONLY_GROUP, STAFF_ROLE, SUPERUSER_ROLE])
+NO_ROLES = frozenset()
+MEMBERSHIP_KEY = 'netbox_plugin_azuread:membership:{}'
+OBJECT_ID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+
+class Resolution(namedtuple('Resolution', ['groups', 'is_staff', 'is_superuser', 'extra_groups'])):
+    __slots__ = ()
+
+    @property
+    def group_names(self):
+        return self.groups | self.extra_groups
+
+
+class GroupResolver:
+    __slots__ = ('group_filter', 'filter_names', 'filter_ids', 'roles')
+
+    def __init__(self, group_map, group_filter):
+        group_map = group_map or {}
+        group_filter = group_filter or []
+        if not isinstance(group_map, dict):
+            raise ImproperlyConfigured("AD_GROUP_MAP must be a dictionary of privileges to lists of groups")
+        unknown = set(group_map) - ROLES
+        if unknown:
+            raise ImproperlyConfigured(
+                f"AD_GROUP_MAP contains unknown privileges {', '.join(sorted(unknown))}, "
+                f"expected any of {', '.join(sorted(ROLES))}"
+            )
+        for role, groups in group_map.items():
+            if isinstance(groups, str) or not all(isinstance(group, str) for group in groups):
+                raise ImproperlyConfigured(f"AD_GROUP_MAP['{role}'] must be a list of group names or ids")
+        if isinstance(group_filter, str) or not all(isinstance(group, str) for group in group_filter):
+            raise ImproperlyConfigured("AD_GROUP_FILTER must be a list of group names or ids")
+
+        # Groups can be referenced by display name or object id so both end up in the same index
+        index = {}
+        for role, groups in group_map.items():
+            for group in groups:
+                index.setdefault(group, set()).add(role)
+        self.group_filter = frozenset(group_filter)
+        self.filter_ids = frozenset(group for group in group_filter if OBJECT_ID_PATTERN.match(group))
+        self.filter_names = self.group_filter - self.filter_ids
+        self.roles = MappingProxyType({group: frozenset(roles) for group, roles in index.items()})
+
+    def allows(self, name, group_id=None):
+        return not self.group_filter or name in self.group_filter or group_id in self.group_filter
+
+    def resolve(self, azure_groups, app_roles=()):
+        groups = set()
+        roles = set()
+        for app_role in app_roles:
+            roles |= self.roles.get(app_role, NO_ROLES)
+        for group in azure_groups:
+            if not self.allows(group.name, group.id):
+                continue
+            if group.name:
+                groups.add(group.name)
+            roles |= self.roles.get(group.name, NO_ROLES) | self.roles.get(group.id, NO_ROLES)
+        is_superuser = SUPERUSER_ROLE in roles
+        return Resolution(
+            groups=frozenset(groups),
+            is_staff=is_superuser or STAFF_ROLE in roles,
+            is_superuser=is_superuser,
+            extra_groups=frozenset([READ_ONLY_GROUP]) if READ_ONLY_GROUP in roles else NO_ROLES
+        )
+
+
+_RESOLVER = None
+
+
+def load_resolver():
+    global _RESOLVER
+    _RESOLVER = GroupResolver(PLUGIN_SETTINGS.get('AD_GROUP_MAP'), PLUGIN_SETTINGS.get('AD_GROUP_FILTER'))
+    return _RESOLVER
+
+
+def get_resolver():
+    return _RESOLVER or load_resolver()
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(sender, setting, **kwargs):
+    global _RESOLVER
+    if setting == 'PLUGINS_CONFIG':
+        _RESOLVER = None
+
+
+def membership_fingerprint(resolution):
+    if resolution is None:
+        # Kept apart from an empty resolution, which removes the user from their groups where this doesn't
+        payload = 'unresolved'
+    else:
+        payload = '\n'.join(sorted(resolution.group_names))
+        payload += f'|{int(resolution.is_staff)}|{int(resolution.is_superuser)}'
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def get_last_sync(cache, user):
+    return cache.get(MEMBERSHIP_KEY.format(user.pk))
+
+
+def record_sync(cache, user, fingerprint, ttl):
+    cache.set(MEMBERSHIP_KEY.format(user.pk), {'fingerprint': fingerprint, 'synced_at': time.time()}, timeout=ttl)
+
+
+def reconcile_user_groups(user, group_names):
+    # Diff against the user's current groups so the query count depends on what changed,
+    # not on how many groups exist in Netbox
+    current = dict(user.groups.values_list('name', 'id'))
+    missing = [name for name in group_names if name not in current]
+    if missing:
+        Group.objects.bulk_create([Group(name=name) for name in missing], ignore_conflicts=True)
+        user.groups.add(*Group.objects.filter(name__in=missing).values_list('id', flat=True))
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("Added %s to %s", user.email, ', '.join(sorted(missing)))
+    stale = {name: group_id for name, group_id in current.items() if name not in group_names}
+    if stale:
+        user.groups.remove(*stale.values())
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("Removed %s from %s", user.email, ', '.join(sorted(stale)))
+    return missing, list(stale)
+
+
+def delete_unfiltered_groups(group_filter, keep=()):
+    result, _ = Group.objects.exclude(name__in=set(group_filter) | set(keep)).delete()
+    if result:
+        LOGGER.debug("Deleted groups that aren't defined in AD_GROUP_FILTER")
+    return result
@@ -0,0 +1,103 @@
+import logging
+import threading
+import uuid
+
+from django.core.cache import caches
+
+from .conf import PLUGIN_SETTINGS
+from .directory import AzureGroup
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+HIERARCHY_VERSION_KEY = 'netbox_plugin_azuread:group_hierarchy:version'
+
+
+class GroupHierarchy:
+    # Which groups each Azure AD group is directly a member of. Every worker keeps one in memory and
+    # only reloads it from the database when azuread_sync bumps the version in the shared cache
+
+    def __init__(self, version, parents, names):
+        self.version = version
+        self.parents = parents
+        self.names = names
+        self.memo = {}
+        self.lock = threading.Lock()
+
+    def _ancestors(self, group_id, visiting):
+        # Memoised, so a branch shared by many groups or users is only walked once per worker. Azure AD
+        # doesn't allow cycles but a half synced hierarchy could still have one, and a group whose walk
+        # ran into a group still being walked only has part of the answer, so it isn't memoised
+        ancestors = self.memo.get(group_id)
+        if ancestors is not None:
+            return ancestors, True
+        visiting.add(group_id)
+        found = set()
+        complete = True
+        for parent in self.parents.get(group_id, ()):
+            found.add(parent)
+            if parent in visiting:
+                complete = False
+                continue
+            parent_ancestors, parent_complete = self._ancestors(parent, visiting)
+            found |= parent_ancestors
+            complete = complete and parent_complete
+        visiting.discard(group_id)
+        ancestors = frozenset(found)
+        if complete:
+            self.memo[group_id] = ancestors
+        return ancestors, complete
+
+    def expand(self, azure_groups):
+        # Adds every group the user is in through nesting to the groups they're directly in
+        direct = {group.id for group in azure_groups if group.id}
+        inherited = set()
+        with self.lock:
+            for group_id in direct:
+                # Whatever a walk skips is on its own stack and gets walked there, so the outermost answer is whole
+                inherited |= self._ancestors(group_id, set())[0]
+        inherited -= direct
+        if not inherited:
+            return azure_groups
+        return list(azure_groups) + [AzureGroup(id=group_id, name=self.names.get(group_id)) for group_id in inherited]
+
+
+def load_hierarchy(version):
+    from .models import AzureADGroup
+
+    object_ids = {}
+    names = {}
+    for pk, object_id, name in AzureADGroup.objects.values_list('pk', 'object_id', 'name').iterator():
+        object_ids[pk] = str(object_id)
+        if name:
+            names[object_ids[pk]] = name
+    parents = {}
+    edges = AzureADGroup.parents.through.objects.values_list('from_azureadgroup_id', 'to_azureadgroup_id')
+    for child, parent in edges.iterator():
+        parents.setdefault(object_ids[child], []).append(object_ids[parent])
+    LOGGER.debug("Loaded a group hierarchy of %d groups with %d nested in others", len(object_ids), len(parents))
+    return GroupHierarchy(version, {child: tuple(groups) for child, groups in parents.items()}, names)
+
+
+_HIERARCHY = None
+_HIERARCHY_LOCK = threading.Lock()
+
+
+def get_hierarchy():
+    # Costs a single cache read per login unless the hierarchy has changed since this worker loaded it
+    global _HIERARCHY
+    cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+    version = cache.get(HIERARCHY_VERSION_KEY)
+    if version is None:
+        cache.add(HIERARCHY_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(HIERARCHY_VERSION_KEY)
+    hierarchy = _HIERARCHY
+    if hierarchy is None or hierarchy.version != version:
+        with _HIERARCHY_LOCK:
+            hierarchy = _HIERARCHY
+            if hierarchy is None or hierarchy.version != version:
+                hierarchy = _HIERARCHY = load_hierarchy(version)
+    return hierarchy
+
+
+def hierarchy_changed():
+    caches[PLUGIN_SETTINGS['CACHE_ALIAS']].set(HIERARCHY_VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,57 @@
+import logging
+
+from django.contrib.auth import get_user_model
+import django_rq
+
+from .conf import PLUGIN_SETTINGS
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+SYNC_JOB_ID = 'netbox_plugin_azuread.sync_groups.{}'
+FOLLOW_UP_JOB_ID = 'netbox_plugin_azuread.sync_groups.{}.follow_up'
+WAITING_STATUSES = frozenset(['queued', 'deferred', 'scheduled'])
+# Only the claims that feed into a group sync are handed to the worker
+SYNC_CLAIMS = ('oid', 'preferred_username', 'groups', 'roles', 'hasgroups', '_claim_names')
+
+
+def enqueue_group_sync(user, claims):
+    # A user only ever has one sync waiting, which always carries the claims from their latest login.
+    # When a sync is already running with older claims, the next one is queued under the other job id
+    # to run after it, so the two never run at the same time or finish out of order
+    queue = django_rq.get_queue(PLUGIN_SETTINGS['GROUP_SYNC_QUEUE'])
+    claims = {key: claims[key] for key in SYNC_CLAIMS if key in claims}
+    job_ids = (SYNC_JOB_ID.format(user.pk), FOLLOW_UP_JOB_ID.format(user.pk))
+    for running_id, next_id in (job_ids, job_ids[::-1]):
+        running = queue.fetch_job(running_id)
+        if running is not None and running.get_status() == 'started':
+            return _enqueue(queue, next_id, user, claims, depends_on=running)
+    return _enqueue(queue, job_ids[0], user, claims)
+
+
+def _enqueue(queue, job_id, user, claims, depends_on=None):
+    job = queue.fetch_job(job_id)
+    if job is not None and job.get_status() in WAITING_STATUSES:
+        LOGGER.debug("A group sync for %s is already pending, updating its claims", user.username)
+        job.args = (user.pk, claims)
+        job.save()
+        return job
+    LOGGER.debug("Queueing a group sync for %s", user.username)
+    return queue.enqueue(
+        sync_user_groups,
+        user.pk,
+        claims,
+        job_id=job_id,
+        result_ttl=0,
+        depends_on=depends_on
+    )
+
+
+def sync_user_groups(user_id, claims):
+    from .backends import AzureADRemoteUserBackend
+
+    try:
+        user = get_user_model().objects.get(pk=user_id)
+    except get_user_model().DoesNotExist:
+        LOGGER.debug("Skipping group sync for user %s as they no longer exist", user_id)
+        return
+    AzureADRemoteUserBackend().sync_groups(user, claims)
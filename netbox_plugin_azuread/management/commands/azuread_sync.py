@@ -0,0 +1,306 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from netbox_plugin_azuread.backends import AzureADRemoteUserBackend
+from netbox_plugin_azuread.conf import PLUGIN_SETTINGS
+from netbox_plugin_azuread.exceptions import GraphError
+from netbox_plugin_azuread.graph import RETRY_STATUSES, GraphClient, get_group_names
+from netbox_plugin_azuread.groups import MEMBERSHIP_KEY, READ_ONLY_GROUP, get_resolver
+from netbox_plugin_azuread.hierarchy import hierarchy_changed
+from netbox_plugin_azuread.models import AzureADGroup, AzureADUser, DeltaLink
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+USERS_DELTA = '/users/delta?$select=id,userPrincipalName,mail,givenName,surname'
+GROUPS_DELTA = '/groups/delta?$select=id,displayName,members'
+USER_TYPE = '#microsoft.graph.user'
+GROUP_TYPE = '#microsoft.graph.group'
+PROFILE_FIELDS = {
+    'email': 'mail',
+    'first_name': 'givenName',
+    'last_name': 'surname',
+}
+
+
+class Command(BaseCommand):
+    help = "Sync users, groups and group memberships from Azure AD using MS Graph delta queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true',
+            help="Ignore any saved delta links and read the whole directory"
+        )
+        parser.add_argument(
+            '--skip-users', action='store_true',
+            help="Don't sync users"
+        )
+        parser.add_argument(
+            '--skip-groups', action='store_true',
+            help="Don't sync groups or memberships"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            self._sync(options)
+        except GraphError as ex:
+            raise CommandError(f"MS Graph failed during the sync: {ex}") from ex
+
+    def _sync(self, options):
+        access_token = AzureADRemoteUserBackend().acquire_client_token()
+        if not access_token:
+            raise CommandError("Failed to acquire an access token for MS Graph")
+        self.client = GraphClient(access_token)
+        self.cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+        self.resolver = get_resolver()
+        self.User = get_user_model()
+        self.Membership = self.User.groups.through
+
+        if not options['skip_users']:
+            created, updated = 0, 0
+            for page in self._iter_delta('users', USERS_DELTA, options['full']):
+                page_created, page_updated = self._sync_users(page.get('value', []))
+                created += page_created
+                updated += page_updated
+            self.stdout.write(f"Users: {created} created, {updated} updated")
+
+        if not options['skip_groups']:
+            added, removed = 0, 0
+            nested = PLUGIN_SETTINGS['NESTED_GROUPS']
+            full = options['full']
+            self.hierarchy_changed = False
+            if nested and not full and not AzureADGroup.objects.exists():
+                # The saved delta link only brings changes, and none of them were recorded while
+                # NESTED_GROUPS was off, so the hierarchy has to be read from scratch
+                self.stdout.write("No group hierarchy has been saved yet, reading every group")
+                full = True
+            elif not nested and AzureADGroup.objects.exists():
+                # Changes from here on won't be recorded, so the hierarchy is dropped rather than left to go stale
+                AzureADGroup.objects.all().delete()
+                self.hierarchy_changed = True
+            on_full = self._reset_hierarchy if nested else None
+            for page in self._iter_delta('groups', GROUPS_DELTA, full, on_full=on_full):
+                if nested:
+                    self._sync_hierarchy(page.get('value', []))
+                page_added, page_removed = self._sync_groups(page.get('value', []))
+                added += page_added
+                removed += page_removed
+            self.stdout.write(f"Memberships: {added} added, {removed} removed")
+            if self.hierarchy_changed:
+                # Workers reload the hierarchy on their next login
+                hierarchy_changed()
+
+    def _iter_delta(self, resource, start_url, full, on_full=None):
+        # Pages are handed out one at a time so memory stays flat however big the tenant is.
+        # The delta link is only saved once the final page has been processed
+        state = None if full else DeltaLink.objects.filter(resource=resource).first()
+        url = state.link if state else start_url
+        if state is None and on_full is not None:
+            on_full()
+        headers = {'Prefer': f"odata.maxpagesize={PLUGIN_SETTINGS['GRAPH_PAGE_SIZE']}"}
+        delta_link = None
+        try:
+            for page in self.client.iter_pages(url, headers=headers):
+                yield page
+                delta_link = page.get('@odata.deltaLink', delta_link)
+        except GraphError as ex:
+            # Expired or otherwise rejected delta links come back as client errors
+            rejected = ex.status_code is not None and ex.status_code < 500 and ex.status_code not in RETRY_STATUSES
+            if state is not None and rejected:
+                self.stderr.write(f"Saved {resource} delta link was rejected, starting a full sync")
+                yield from self._iter_delta(resource, start_url, True, on_full=on_full)
+                return
+            raise CommandError(f"MS Graph failed the {resource} delta query: {ex}") from ex
+        if delta_link:
+            DeltaLink.objects.update_or_create(resource=resource, defaults={'link': delta_link})
+
+    def _sync_users(self, entries):
+        profiles = {
+            entry['id']: entry
+            for entry in entries
+            if '@removed' not in entry and entry.get('userPrincipalName')
+        }
+        if not profiles:
+            return 0, 0
+        # Users are matched on their object id first so a UPN rename updates the existing user
+        linked = dict(AzureADUser.objects.filter(object_id__in=profiles).values_list('object_id', 'user_id'))
+        linked = {str(object_id): user_pk for object_id, user_pk in linked.items()}
+        usernames = {profile['userPrincipalName'] for profile in profiles.values()}
+        users = self.User.objects.filter(Q(pk__in=linked.values()) | Q(username__in=usernames))
+        by_pk = {user.pk: user for user in users}
+        by_username = {user.username: user for user in by_pk.values()}
+        links = dict(AzureADUser.objects.filter(user_id__in=by_pk).values_list('user_id', 'object_id'))
+        changed = []
+        new_users = []
+        skipped = set()
+        for object_id, profile in profiles.items():
+            username = profile['userPrincipalName']
+            user = by_pk.get(linked.get(object_id))
+            if user is None:
+                user = by_username.get(username)
+                if user is not None and user.pk in links:
+                    # The same conflict find_user refuses logins over, the username now belongs to another object
+                    self.stderr.write(f"Skipping {username}, who is already linked to Azure AD object {links[user.pk]}")
+                    skipped.add(object_id)
+                    continue
+            if user is None:
+                if not settings.REMOTE_AUTH_AUTO_CREATE_USER:
+                    skipped.add(object_id)
+                    continue
+                user = self.User(username=username, **{
+                    field: profile.get(attribute) or '' for field, attribute in PROFILE_FIELDS.items()
+                })
+                user.set_unusable_password()
+                new_users.append(user)
+                continue
+            dirty = False
+            if user.username != username and username not in by_username:
+                user.username = username
+                dirty = True
+            for field, attribute in PROFILE_FIELDS.items():
+                if attribute in profile and getattr(user, field) != (profile[attribute] or ''):
+                    setattr(user, field, profile[attribute] or '')
+                    dirty = True
+            if dirty:
+                changed.append(user)
+        with transaction.atomic():
+            if changed:
+                self.User.objects.bulk_update(changed, ['username', *PROFILE_FIELDS])
+            if new_users:
+                self.User.objects.bulk_create(new_users, ignore_conflicts=True)
+            # Users already linked to another object, or linked already, are left as they are
+            user_pks = dict(self.User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+            AzureADUser.objects.bulk_create([
+                AzureADUser(object_id=object_id, user_id=user_pks[profile['userPrincipalName']])
+                for object_id, profile in profiles.items()
+                if object_id not in skipped and profile['userPrincipalName'] in user_pks
+            ], ignore_conflicts=True)
+        return len(new_users), len(changed)
+
+    def _reset_hierarchy(self):
+        # A full read lists every nesting afresh, and never says which ones went away
+        AzureADGroup.parents.through.objects.all().delete()
+        self.hierarchy_changed = True
+
+    def _sync_hierarchy(self, entries):
+        # Every group is recorded, not just the filtered ones, as nesting can run through groups the filter skips
+        Parent = AzureADGroup.parents.through
+        removed_groups = [entry['id'] for entry in entries if '@removed' in entry]
+        entries = [entry for entry in entries if '@removed' not in entry]
+        edges = [
+            (member['id'], entry['id'], '@removed' in member)
+            for entry in entries
+            for member in entry.get('members@delta', [])
+            if member.get('@odata.type') == GROUP_TYPE
+        ]
+        group_ids = {entry['id'] for entry in entries} | {child for child, _, _ in edges}
+        with transaction.atomic():
+            if removed_groups:
+                AzureADGroup.objects.filter(object_id__in=removed_groups).delete()
+            # Nested groups can show up as members before their own entry, so they start out unnamed
+            AzureADGroup.objects.bulk_create(
+                [AzureADGroup(object_id=group_id) for group_id in group_ids], ignore_conflicts=True
+            )
+            groups = {str(group.object_id): group for group in AzureADGroup.objects.filter(object_id__in=group_ids)}
+            renamed = []
+            for entry in entries:
+                group = groups[entry['id']]
+                if entry.get('displayName') and group.name != entry['displayName']:
+                    group.name = entry['displayName']
+                    renamed.append(group)
+            if renamed:
+                AzureADGroup.objects.bulk_update(renamed, ['name'])
+            additions = [
+                Parent(from_azureadgroup_id=groups[child].pk, to_azureadgroup_id=groups[parent].pk)
+                for child, parent, removed in edges
+                if not removed
+            ]
+            if additions:
+                Parent.objects.bulk_create(additions, ignore_conflicts=True)
+            removals = {}
+            for child, parent, removed in edges:
+                if removed:
+                    removals.setdefault(groups[parent].pk, []).append(groups[child].pk)
+            for parent_pk, child_pks in removals.items():
+                Parent.objects.filter(to_azureadgroup_id=parent_pk, from_azureadgroup_id__in=child_pks).delete()
+        if removed_groups or renamed or additions or removals:
+            self.hierarchy_changed = True
+
+    def _sync_groups(self, entries):
+        unnamed = [entry['id'] for entry in entries if '@removed' not in entry and not entry.get('displayName')]
+        names = get_group_names(unnamed, self.cache, lambda: self.client) if unnamed else {}
+        for entry in entries:
+            if entry.get('displayName'):
+                names[entry['id']] = entry['displayName']
+
+        # Membership changes come through as (group name, member object id, removed)
+        changes = []
+        group_names = set()
+        for entry in entries:
+            if '@removed' in entry:
+                continue
+            name = names.get(entry['id'])
+            if not name or not self.resolver.allows(name, entry['id']):
+                continue
+            group_names.add(name)
+            read_only = READ_ONLY_GROUP in (
+                self.resolver.roles.get(name, frozenset()) | self.resolver.roles.get(entry['id'], frozenset())
+            )
+            if read_only:
+                group_names.add(READ_ONLY_GROUP)
+            for member in entry.get('members@delta', []):
+                if member.get('@odata.type') != USER_TYPE:
+                    continue
+                removed = '@removed' in member
+                changes.append((name, member['id'], removed))
+                if read_only and not removed:
+                    changes.append((READ_ONLY_GROUP, member['id'], False))
+        if not group_names:
+            return 0, 0
+
+        # Linked members are resolved locally, MS Graph is only asked about the rest
+        member_ids = {member_id for _, member_id, _ in changes}
+        user_pks = {
+            str(object_id): user_pk
+            for object_id, user_pk in AzureADUser.objects.filter(object_id__in=member_ids).values_list(
+                'object_id', 'user_id'
+            )
+        }
+        unlinked = member_ids - user_pks.keys()
+        if unlinked:
+            usernames = {}
+            for entry in self.client.get_by_ids(unlinked, types=['user']):
+                if entry.get('userPrincipalName'):
+                    usernames[entry['userPrincipalName']] = entry['id']
+            # Users linked to another object only share the username, they aren't the member
+            unlinked_users = self.User.objects.filter(username__in=usernames, azuread__isnull=True)
+            for username, user_pk in unlinked_users.values_list('username', 'pk'):
+                user_pks[usernames[username]] = user_pk
+
+        with transaction.atomic():
+            Group.objects.bulk_create([Group(name=name) for name in group_names], ignore_conflicts=True)
+            group_pks = dict(Group.objects.filter(name__in=group_names).values_list('name', 'pk'))
+            additions, removals = set(), set()
+            for name, member_id, removed in changes:
+                user_pk = user_pks.get(member_id)
+                if user_pk is None:
+                    continue
+                (removals if removed else additions).add((user_pk, group_pks[name]))
+            if additions:
+                self.Membership.objects.bulk_create([
+                    self.Membership(user_id=user_pk, group_id=group_pk) for user_pk, group_pk in additions
+                ], ignore_conflicts=True)
+            removed_by_group = {}
+            for user_pk, group_pk in removals:
+                removed_by_group.setdefault(group_pk, []).append(user_pk)
+            for group_pk, removed_users in removed_by_group.items():
+                self.Membership.objects.filter(group_id=group_pk, user_id__in=removed_users).delete()
+        # Memberships changed underneath the login sync so its fingerprints are no longer valid
+        self.cache.delete_many([MEMBERSHIP_KEY.format(user_pk) for user_pk, _ in additions | removals])
+        return len(additions), len(removals)
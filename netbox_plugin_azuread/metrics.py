@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .conf import PLUGIN_SETTINGS
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+CIRCUIT_STATES = ('closed', 'open', 'half_open')
+
+
+class NoopMetrics:
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    @contextmanager
+    def count_queries(self):
+        yield
+
+    def graph_response(self, status_code):
+        pass
+
+    def graph_retry(self, reason):
+        pass
+
+    def cache_lookup(self, cache, hit):
+        pass
+
+    def coalesced(self, scope):
+        pass
+
+    def circuit_state(self, circuit, state):
+        pass
+
+    def stale_permissions(self):
+        pass
+
+
+class _QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class PrometheusMetrics(NoopMetrics):
+    # Registered with prometheus_client's default registry, which Netbox already exposes on /metrics
+
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.phase_seconds = Histogram(
+            'netbox_azuread_login_phase_seconds',
+            'Time spent in each phase of an Azure AD login',
+            ['phase']
+        )
+        self.graph_responses = Counter(
+            'netbox_azuread_graph_responses_total',
+            'MS Graph responses by status code',
+            ['status']
+        )
+        self.graph_retries = Counter(
+            'netbox_azuread_graph_retries_total',
+            'MS Graph requests that were retried',
+            ['reason']
+        )
+        self.cache_lookups = Counter(
+            'netbox_azuread_cache_lookups_total',
+            'Lookups against the plugin caches',
+            ['cache', 'result']
+        )
+        self.coalesced_calls = Counter(
+            'netbox_azuread_coalesced_total',
+            'Logins that waited on and reused another login for the same user',
+            ['scope']
+        )
+        # Enum isn't supported by prometheus_client's multiprocess mode, which gunicorn deployments use.
+        # Breakers are per worker, so each live worker reports its own
+        self.circuit_states = Gauge(
+            'netbox_azuread_circuit_state',
+            'State of the circuit breakers in front of Azure AD services, 1 for the current state',
+            ['circuit', 'state'],
+            multiprocess_mode='liveall'
+        )
+        self.stale_logins = Counter(
+            'netbox_azuread_stale_permission_logins_total',
+            'Logins that kept the permissions from an earlier sync because MS Graph was unavailable'
+        )
+        self.sync_queries = Histogram(
+            'netbox_azuread_group_sync_queries',
+            'Database queries made by a single group sync',
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+        )
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds.labels(phase=name).observe(time.perf_counter() - start)
+
+    @contextmanager
+    def count_queries(self):
+        counter = _QueryCounter()
+        with connection.execute_wrapper(counter):
+            yield
+        self.sync_queries.observe(counter.count)
+
+    def graph_response(self, status_code):
+        self.graph_responses.labels(status=str(status_code)).inc()
+
+    def graph_retry(self, reason):
+        self.graph_retries.labels(reason=reason).inc()
+
+    def cache_lookup(self, cache, hit):
+        self.cache_lookups.labels(cache=cache, result='hit' if hit else 'miss').inc()
+
+    def coalesced(self, scope):
+        self.coalesced_calls.labels(scope=scope).inc()
+
+    def circuit_state(self, circuit, state):
+        for name in CIRCUIT_STATES:
+            self.circuit_states.labels(circuit=circuit, state=name).set(1 if name == state else 0)
+
+    def stale_permissions(self):
+        self.stale_logins.inc()
+
+
+_METRICS = None
+_METRICS_LOCK = threading.Lock()
+
+
+def get_metrics():
+    # Metrics can only be registered once per process so the backend is shared
+    global _METRICS
+    if _METRICS is not None:
+        return _METRICS
+    with _METRICS_LOCK:
+        if _METRICS is None:
+            backend = PLUGIN_SETTINGS['METRICS_BACKEND']
+            if backend is None:
+                backend = PrometheusMetrics if getattr(settings, 'METRICS_ENABLED', False) else NoopMetrics
+            elif isinstance(backend, str):
+                backend = import_string(backend)
+            try:
+                _METRICS = backend()
+            except Exception as ex:
+                # A misconfigured metrics library mustn't take logins down with it
+                LOGGER.warning("Failed to set up metrics, they will be disabled: %s", ex)
+                _METRICS = NoopMetrics()
+    return _METRICS
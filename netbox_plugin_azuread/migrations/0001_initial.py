@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name='DeltaLink',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('resource', models.CharField(max_length=50, unique=True)),
+                ('link', models.TextField()),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
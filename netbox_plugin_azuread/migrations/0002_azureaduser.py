@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('netbox_plugin_azuread', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AzureADUser',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('object_id', models.UUIDField(unique=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='azuread',
+                    to=settings.AUTH_USER_MODEL
+                )),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_plugin_azuread', '0002_azureaduser'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AzureADGroup',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('object_id', models.UUIDField(unique=True)),
+                ('name', models.CharField(blank=True, max_length=256)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('parents', models.ManyToManyField(
+                    blank=True,
+                    related_name='children',
+                    to='netbox_plugin_azuread.AzureADGroup'
+                )),
+            ],
+        ),
+    ]
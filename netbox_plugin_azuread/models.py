@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import models
+
+
+class DeltaLink(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    resource = models.CharField(max_length=50, unique=True)
+    link = models.TextField()
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.resource
+
+
+class AzureADUser(models.Model):
+    # Ties a Netbox user to their Azure AD object id, which unlike the UPN never changes
+    id = models.BigAutoField(primary_key=True)
+    object_id = models.UUIDField(unique=True)
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='azuread')
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.object_id)
+
+
+class AzureADGroup(models.Model):
+    # The Azure AD group hierarchy as read by azuread_sync, used to work out nested memberships locally
+    id = models.BigAutoField(primary_key=True)
+    object_id = models.UUIDField(unique=True)
+    name = models.CharField(max_length=256, blank=True)
+    parents = models.ManyToManyField('self', symmetrical=False, related_name='children', blank=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name or str(self.object_id)
@@ -0,0 +1,80 @@
+import hashlib
+import logging
+import threading
+import time
+
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+FLIGHT_KEY = 'netbox_plugin_azuread:flight:{}'
+FLIGHT_POLL_INTERVAL = 0.1
+# How long a finished flight's result is kept for callers in other workers that were waiting on it
+FLIGHT_RESULT_TTL = 10
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_FLIGHTS = {}
+_FLIGHTS_LOCK = threading.Lock()
+
+
+def single_flight(key, fn, cache=None, timeout=30):
+    # Runs fn once for everyone asking for the same key at the same time. Threads in this worker wait
+    # on the first caller and get its result, or its exception. With a cache, workers elsewhere wait on
+    # a lock and pick the result up from the cache, running fn themselves if it never turns up
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(key)
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[key] = _Flight()
+
+    if not leader:
+        get_metrics().coalesced('process')
+        if flight.done.wait(timeout):
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        LOGGER.debug("Timed out waiting on another thread for %s", key)
+        return fn()
+
+    try:
+        flight.result = _shared_flight(key, fn, cache, timeout) if cache is not None else fn()
+        return flight.result
+    except Exception as ex:
+        flight.error = ex
+        raise
+    finally:
+        with _FLIGHTS_LOCK:
+            _FLIGHTS.pop(key, None)
+        flight.done.set()
+
+
+def _shared_flight(key, fn, cache, timeout):
+    result_key = FLIGHT_KEY.format(hashlib.sha256(key.encode()).hexdigest())
+    lock_key = f'{result_key}:lock'
+    if not cache.add(lock_key, 1, timeout):
+        get_metrics().coalesced('cache')
+        deadline = time.time() + timeout
+        while time.time() < deadline and cache.get(lock_key) is not None:
+            time.sleep(FLIGHT_POLL_INTERVAL)
+        result = cache.get(result_key)
+        if result is not None:
+            return result
+        LOGGER.debug("No result from another worker for %s, running it here", key)
+        return fn()
+
+    try:
+        result = fn()
+        if result is not None:
+            cache.set(result_key, result, FLIGHT_RESULT_TTL)
+        return result
+    finally:
+        cache.delete(lock_key)
@@ -0,0 +1,94 @@
+from collections import namedtuple
+from urllib.parse import urlparse
+import base64
+import hashlib
+import hmac
+import logging
+import re
+import secrets
+
+from django.core import signing
+from django.core.cache import caches
+
+from .conf import PLUGIN_SETTINGS
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+STATE_COOKIE = 'azuread_state_{}'
+STATE_SALT = 'netbox_plugin_azuread.state'
+STATE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+USED_STATE_KEY = 'netbox_plugin_azuread:used_state:{}'
+
+
+class LoginState(namedtuple('LoginState', ['state', 'nonce', 'next_url', 'code_verifier'])):
+    # Everything a login needs to carry from the login page to the reply URL. It lives in a signed
+    # cookie rather than the session so that loading the login page never writes to the database
+    __slots__ = ()
+
+    @property
+    def cookie_name(self):
+        return STATE_COOKIE.format(self.state)
+
+    @property
+    def code_challenge(self):
+        digest = hashlib.sha256(self.code_verifier.encode()).digest()
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+
+def new_login_state(next_url):
+    return LoginState(
+        state=secrets.token_urlsafe(24),
+        nonce=secrets.token_urlsafe(24),
+        next_url=next_url,
+        code_verifier=secrets.token_urlsafe(48)
+    )
+
+
+def _cookie_path(redirect_url):
+    # The cookie is only ever needed by the reply URL so it isn't sent with every other request
+    return urlparse(redirect_url).path or '/'
+
+
+def set_login_state(response, login_state, redirect_url, secure):
+    # Each login gets its own cookie, named after its state, so logins started in several tabs don't clash
+    response.set_cookie(
+        login_state.cookie_name,
+        signing.dumps(list(login_state), salt=STATE_SALT, compress=True),
+        max_age=PLUGIN_SETTINGS['LOGIN_STATE_MAX_AGE'],
+        path=_cookie_path(redirect_url),
+        secure=secure,
+        httponly=True,
+        samesite='Lax'
+    )
+
+
+def read_login_state(request):
+    # Returns None unless the state Azure AD handed back matches an unexpired cookie we signed,
+    # and that state hasn't already been used to log in
+    state = request.GET.get('state', '')
+    if not STATE_PATTERN.match(state):
+        return None
+    value = request.COOKIES.get(STATE_COOKIE.format(state))
+    if not value:
+        LOGGER.debug("No login state cookie for state %s", state)
+        return None
+    try:
+        login_state = LoginState(*signing.loads(
+            value, salt=STATE_SALT, max_age=PLUGIN_SETTINGS['LOGIN_STATE_MAX_AGE']
+        ))
+    except (signing.BadSignature, TypeError, ValueError) as ex:
+        LOGGER.debug("Rejected login state cookie: %s", ex)
+        return None
+    if not hmac.compare_digest(login_state.state, state):
+        return None
+    cache = caches[PLUGIN_SETTINGS['CACHE_ALIAS']]
+    if not cache.add(USED_STATE_KEY.format(state), 1, PLUGIN_SETTINGS['LOGIN_STATE_MAX_AGE']):
+        LOGGER.warning("Login state %s was replayed", state)
+        return None
+    return login_state
+
+
+def clear_login_state(response, request, redirect_url):
+    name = STATE_COOKIE.format(request.GET.get('state', ''))
+    if name in request.COOKIES:
+        response.delete_cookie(name, path=_cookie_path(redirect_url))
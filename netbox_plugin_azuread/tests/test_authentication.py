@@ -0,0 +1,135 @@
+from importlib.util import find_spec
+from unittest import mock, skipUnless
+import base64
+import json
+import time
+
+from django.test import SimpleTestCase
+from rest_framework.exceptions import AuthenticationFailed
+
+from netbox_plugin_azuread import authentication
+from netbox_plugin_azuread.authentication import SigningKeys, check_app_token, validate_token
+
+from .utils import plugin_settings
+
+CLIENT_ID = '11111111-1111-1111-1111-111111111111'
+TENANT_ID = '22222222-2222-2222-2222-222222222222'
+ISSUER = f'https://login.microsoftonline.com/{TENANT_ID}/v2.0'
+KEY_ID = 'test-key'
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+
+def generate_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@skipUnless(find_spec('jwt'), "API_AUTHENTICATION needs the api extra")
+@plugin_settings(CLIENT_ID=CLIENT_ID, API_AUDIENCES=[], API_ISSUERS=[], API_CLOCK_SKEW=60)
+class ValidateTokenTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key = generate_key()
+
+    def setUp(self):
+        # Signing keys are handed over directly rather than fetched from Azure AD, and the last refresh is
+        # recent so an unknown key doesn't send the test off to the network
+        keys = SigningKeys()
+        keys.keys = {KEY_ID: self.private_key.public_key()}
+        keys.issuers = frozenset([ISSUER])
+        keys.loaded_at = keys.refreshed_at = time.time()
+        patcher = mock.patch.object(authentication, '_SIGNING_KEYS', keys)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def claims(self, **overrides):
+        now = int(time.time())
+        claims = {
+            'aud': f'api://{CLIENT_ID}',
+            'iss': ISSUER,
+            'iat': now,
+            'nbf': now,
+            'exp': now + 3600,
+            'oid': '33333333-3333-3333-3333-333333333333',
+            'preferred_username': 'alice@example.com',
+            'scp': 'user_impersonation',
+        }
+        claims.update(overrides)
+        return {name: value for name, value in claims.items() if value is not None}
+
+    def token(self, key=None, key_id=KEY_ID, **overrides):
+        import jwt
+        return jwt.encode(self.claims(**overrides), key or self.private_key, algorithm='RS256', headers={'kid': key_id})
+
+    def test_valid_token(self):
+        claims = validate_token(self.token())
+        self.assertEqual(claims['preferred_username'], 'alice@example.com')
+
+    def test_client_id_audience(self):
+        self.assertEqual(validate_token(self.token(aud=CLIENT_ID))['aud'], CLIENT_ID)
+
+    def test_wrong_audience(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(aud='api://someone-else'))
+
+    def test_expired(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(exp=int(time.time()) - 120))
+
+    def test_expiry_within_clock_skew(self):
+        validate_token(self.token(exp=int(time.time()) - 30))
+
+    def test_missing_expiry(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(exp=None))
+
+    def test_untrusted_issuer(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(iss='https://login.microsoftonline.com/another-tenant/v2.0'))
+
+    def test_configured_issuers_replace_the_defaults(self):
+        with plugin_settings(CLIENT_ID=CLIENT_ID, API_ISSUERS=['https://issuer.example/']):
+            validate_token(self.token(iss='https://issuer.example/'))
+            with self.assertRaises(AuthenticationFailed):
+                validate_token(self.token())
+
+    def test_unknown_key(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(key_id='another-key'))
+
+    def test_signed_by_another_key(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(self.token(key=generate_key()))
+
+    def test_unsigned(self):
+        token = f"{b64({'alg': 'none', 'typ': 'JWT', 'kid': KEY_ID})}.{b64(self.claims())}."
+        with self.assertRaises(AuthenticationFailed):
+            validate_token(token)
+
+    def test_not_a_token(self):
+        with self.assertRaises(AuthenticationFailed):
+            validate_token('not-a-token')
+
+
+class CheckAppTokenTestCase(SimpleTestCase):
+
+    @plugin_settings(API_ALLOW_APP_TOKENS=False, AD_GROUP_MAP={'STAFF': ['netbox-automation']})
+    def test_app_tokens_off(self):
+        with self.assertRaises(AuthenticationFailed):
+            check_app_token({'roles': ['netbox-automation']})
+
+    @plugin_settings(API_ALLOW_APP_TOKENS=True, AD_GROUP_MAP={'STAFF': ['netbox-automation']})
+    def test_unmapped_role(self):
+        with self.assertRaises(AuthenticationFailed):
+            check_app_token({'roles': ['something-else']})
+        with self.assertRaises(AuthenticationFailed):
+            check_app_token({})
+
+    @plugin_settings(API_ALLOW_APP_TOKENS=True, AD_GROUP_MAP={'STAFF': ['netbox-automation']})
+    def test_mapped_role(self):
+        check_app_token({'roles': ['netbox-automation']})
@@ -0,0 +1,105 @@
+import uuid
+
+from django.contrib.auth.models import Group, User
+from django.core.cache import caches
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from netbox_plugin_azuread.backends import AzureADRemoteUserBackend
+from netbox_plugin_azuread.directory import AzureGroup
+from netbox_plugin_azuread.groups import MEMBERSHIP_KEY, READ_ONLY_GROUP
+
+from .utils import LOCAL_CACHES, plugin_settings
+
+# The same budgets as develop/benchmark/group_sync_budget.py, which measures far bigger datasets
+QUERY_BUDGETS = {
+    'first': 10,
+    'rebuild': 4,
+    'cached': 0,
+    'changed': 10,
+}
+EXISTING_GROUPS = (10, 2000)
+
+
+def azure_groups(count, offset=0):
+    return [
+        AzureGroup(id=str(uuid.uuid5(uuid.NAMESPACE_OID, f'azure-{index}')), name=f'azure-{index}')
+        for index in range(offset, offset + count)
+    ]
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+@plugin_settings(AD_GROUP_MAP={}, AD_GROUP_FILTER=[], NESTED_GROUPS=False, CHECK_MEMBER_GROUPS=False)
+class GroupSyncBudgetTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = AzureADRemoteUserBackend()
+        self.user = User.objects.create(username='alice@example.com')
+        self.cache = caches['default']
+
+    def prepare(self, phase, memberships):
+        # Puts the user in the state the phase starts from and returns the groups to sync them into
+        self.cache.delete(MEMBERSHIP_KEY.format(self.user.pk))
+        current = azure_groups(memberships)
+        if phase == 'first':
+            Group.objects.filter(name__startswith='azure-').delete()
+            return current
+        self.backend._configure_access_groups(self.user, current)
+        if phase != 'cached':
+            self.cache.delete(MEMBERSHIP_KEY.format(self.user.pk))
+        if phase == 'changed':
+            return current[1:] + azure_groups(1, offset=memberships)
+        return current
+
+    def count_queries(self, phase, memberships):
+        target = self.prepare(phase, memberships)
+        with CaptureQueriesContext(connection) as queries:
+            self.backend._configure_access_groups(self.user, target)
+        return len(queries)
+
+    def test_queries_stay_within_budget_however_many_groups_exist(self):
+        for memberships in (1, 50):
+            for phase, budget in QUERY_BUDGETS.items():
+                counts = []
+                for existing in EXISTING_GROUPS:
+                    Group.objects.bulk_create(
+                        [Group(name=f'existing-{index}') for index in range(existing)], ignore_conflicts=True
+                    )
+                    counts.append(self.count_queries(phase, memberships))
+                with self.subTest(phase=phase, memberships=memberships):
+                    self.assertLessEqual(max(counts), budget)
+                    self.assertEqual(counts[0], counts[-1], "Queries grew with the number of existing groups")
+
+    def test_sync_matches_azure_groups(self):
+        self.backend._configure_access_groups(self.user, azure_groups(3))
+        self.backend._configure_access_groups(self.user, azure_groups(2, offset=1))
+        self.assertEqual(set(self.user.groups.values_list('name', flat=True)), {'azure-1', 'azure-2'})
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+class EmptyGroupsTestCase(TestCase):
+
+    def setUp(self):
+        self.backend = AzureADRemoteUserBackend()
+        self.user = User.objects.create(username='alice@example.com')
+        self.readers = AzureGroup(id=str(uuid.uuid4()), name='netbox-readers')
+
+    def groups(self):
+        return set(self.user.groups.values_list('name', flat=True))
+
+    @plugin_settings(AD_GROUP_MAP={'READ_ONLY': ['netbox-readers']}, AD_GROUP_FILTER=['netbox-readers'],
+                     CHECK_MEMBER_GROUPS=True)
+    def test_no_filtered_groups_removes_every_group(self):
+        # checkMemberGroups fails loudly, so an empty answer means the user really is in none of the groups
+        self.backend._configure_access_groups(self.user, [self.readers])
+        self.assertEqual(self.groups(), {'netbox-readers', READ_ONLY_GROUP})
+        self.backend._configure_access_groups(self.user, [])
+        self.assertEqual(self.groups(), set())
+
+    @plugin_settings(AD_GROUP_MAP={'READ_ONLY': ['netbox-readers']}, AD_GROUP_FILTER=['netbox-readers'],
+                     CHECK_MEMBER_GROUPS=False)
+    def test_no_groups_from_member_of_leaves_groups(self):
+        self.backend._configure_access_groups(self.user, [self.readers])
+        self.backend._configure_access_groups(self.user, [])
+        self.assertEqual(self.groups(), {'netbox-readers', READ_ONLY_GROUP})
@@ -0,0 +1,63 @@
+from unittest import mock
+import time
+
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from netbox_plugin_azuread.state import STATE_COOKIE, new_login_state, read_login_state, set_login_state
+
+from .utils import LOCAL_CACHES, plugin_settings
+
+REPLY_URL = 'https://netbox.example.com/plugins/azuread/complete/'
+
+
+@override_settings(CACHES=LOCAL_CACHES)
+@plugin_settings(LOGIN_STATE_MAX_AGE=600)
+class LoginStateTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.login_state = new_login_state('/dcim/sites/')
+        response = HttpResponse()
+        set_login_state(response, self.login_state, REPLY_URL, secure=True)
+        self.cookie = response.cookies[self.login_state.cookie_name]
+
+    def reply(self, state=None, cookies=None):
+        query = {'code': 'abc', 'state': state or self.login_state.state}
+        request = self.factory.get('/plugins/azuread/complete/', query)
+        request.COOKIES.update(cookies if cookies is not None else {self.cookie.key: self.cookie.value})
+        return request
+
+    def test_cookie_only_goes_to_the_reply_url(self):
+        self.assertEqual(self.cookie['path'], '/plugins/azuread/complete/')
+        self.assertTrue(self.cookie['httponly'])
+        self.assertTrue(self.cookie['secure'])
+
+    def test_round_trip(self):
+        self.assertEqual(read_login_state(self.reply()), self.login_state)
+
+    def test_replay(self):
+        self.assertIsNotNone(read_login_state(self.reply()))
+        self.assertIsNone(read_login_state(self.reply()))
+
+    def test_tampered(self):
+        value = self.cookie.value
+        tampered = value[:-1] + ('A' if value[-1] != 'A' else 'B')
+        self.assertIsNone(read_login_state(self.reply(cookies={self.cookie.key: tampered})))
+
+    def test_expired(self):
+        with mock.patch('time.time', return_value=time.time() + 601):
+            self.assertIsNone(read_login_state(self.reply()))
+
+    def test_missing_cookie(self):
+        self.assertIsNone(read_login_state(self.reply(cookies={})))
+
+    def test_cookie_from_another_login(self):
+        # A valid cookie only unlocks the state it was issued for, even when it's sent under another name
+        other = new_login_state('/')
+        self.assertIsNone(read_login_state(self.reply(
+            state=other.state, cookies={STATE_COOKIE.format(other.state): self.cookie.value}
+        )))
+
+    def test_malformed_state(self):
+        self.assertIsNone(read_login_state(self.reply(state='../../etc')))
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.test import override_settings
+
+from netbox_plugin_azuread.conf import PLUGIN_NAME
+
+# Each test gets an empty cache of its own rather than sharing Netbox's redis
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def plugin_settings(**overrides):
+    # The plugin's caches of its settings are reset through setting_changed, as they would be for any override
+    config = dict(settings.PLUGINS_CONFIG)
+    config[PLUGIN_NAME] = dict(config[PLUGIN_NAME], **overrides)
+    return override_settings(PLUGINS_CONFIG=config)
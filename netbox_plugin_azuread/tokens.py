@@ -0,0 +1,90 @@
+import hashlib
+import logging
+import time
+
+from .metrics import get_metrics
+
+LOGGER = logging.getLogger("netbox_plugin_azuread")
+
+APP_TOKEN_KEY = 'netbox_plugin_azuread:app_token:{}'
+USER_TOKEN_KEY = 'netbox_plugin_azuread:user_tokens:{}'
+APP_TOKEN_LOCK_TIMEOUT = 30
+APP_TOKEN_POLL_INTERVAL = 0.1
+
+
+def _app_token_key(client, scopes):
+    digest = hashlib.sha256(
+        f"{client.authority.token_endpoint}|{client.client_id}|{' '.join(sorted(scopes))}".encode()
+    ).hexdigest()
+    return APP_TOKEN_KEY.format(digest)
+
+
+def _usable(entry, margin=0):
+    return entry is not None and entry['expires_at'] - margin > time.time()
+
+
+def acquire_app_token(client, scopes, cache, refresh_margin):
+    key = _app_token_key(client, scopes)
+    entry = cache.get(key)
+    if _usable(entry, refresh_margin):
+        get_metrics().cache_lookup('app_token', True)
+        return entry['access_token']
+    get_metrics().cache_lookup('app_token', False)
+
+    lock_key = f'{key}:lock'
+    locked = cache.add(lock_key, 1, APP_TOKEN_LOCK_TIMEOUT)
+    if not locked:
+        # Another worker is already refreshing so serve the current token while it's still valid
+        if _usable(entry):
+            return entry['access_token']
+        deadline = time.time() + APP_TOKEN_LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(APP_TOKEN_POLL_INTERVAL)
+            entry = cache.get(key)
+            if _usable(entry):
+                return entry['access_token']
+            if cache.get(lock_key) is None:
+                break
+        LOGGER.debug("Timed out waiting on another worker for an app token, fetching one directly")
+
+    try:
+        requested_at = time.time()
+        result = client.acquire_token_for_client(scopes=scopes)
+        access_token = result.get('access_token')
+        if not access_token:
+            LOGGER.error("Failed to acquire an app token: %s", result.get('error_description', result.get('error')))
+            return None
+        expires_in = int(result.get('expires_in', 0))
+        if expires_in > 0:
+            cache.set(key, {
+                'access_token': access_token,
+                'expires_at': requested_at + expires_in,
+            }, timeout=expires_in)
+        return access_token
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+class CacheTokenStore:
+    # Keeps serialized MSAL token caches in the shared Django cache so the session only holds a key
+
+    def __init__(self, cache, timeout):
+        self.cache = cache
+        self.timeout = timeout
+
+    def load(self, key):
+        return self.cache.get(USER_TOKEN_KEY.format(key))
+
+    def save(self, key, serialized):
+        self.cache.set(USER_TOKEN_KEY.format(key), serialized, timeout=self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(USER_TOKEN_KEY.format(key))
+
+
+def evict_expired_tokens(token_cache, credential_types):
+    now = time.time()
+    for access_token in token_cache.find(credential_types.ACCESS_TOKEN):
+        if int(access_token.get('expires_on', 0)) < now:
+            token_cache.remove_at(access_token)
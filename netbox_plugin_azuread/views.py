@@ -1,24 +1,24 @@
 import logging
-import os
-import uuid
 
 from django.conf import settings
 from django.contrib import messages
 from django.shortcuts import redirect, render
+from django.utils.http import url_has_allowed_host_and_scheme
 
-from .backends import AzureADRemoteUserBackend
+from .conf import PLUGIN_SETTINGS
+from .metrics import get_metrics
+from .state import clear_login_state, new_login_state, read_login_state, set_login_state
 
 LOGGER = logging.getLogger("netbox_plugin_azuread")
-LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-logging.basicConfig(level=LOGLEVEL)
-PLUGIN_SETTINGS = settings.PLUGINS_CONFIG["netbox_plugin_azuread"]
 
 ERROR_MAP = {
     'ACCOUNT_CREATION_FAILED': 'Something went wrong trying to log you in.',
     'ACCOUNT_LOGIN_FAILED': 'Something went wrong trying to create a user account.',
     'ALREADY_AUTHED': 'It appears that you have already logged in.',
+    'INVALID_STATE': 'Your login has expired or was already used, please try again.',
     'MISSING_COMPLETE_URL': 'Redirect URL has not been configured.',
     'MISSING_AUTH_CODE': 'No authorization code could be found.',
+    'STALE_PERMISSIONS': 'Your groups could not be refreshed from Azure AD so the ones from your last login are in use.',
     'USER_TOKEN_FAILURE': 'Failed to acquire a user token.'
 }
 
@@ -29,14 +29,24 @@ if NETBOX_VERSION.startswith('2.'):
     LOGIN_TEMPLATE = 'azure/login_2.x.html'
 
 
+def get_backend():
+    # The backend pulls in MSAL so it's only imported once someone actually logs in,
+    # rather than whenever the URLconf is loaded by system checks or management commands
+    from .backends import AzureADRemoteUserBackend
+    return AzureADRemoteUserBackend()
+
+
 def login(request):
     context = {
         'auth_url': '#',
         'redirect_url': '#'
     }
 
-    request.session['state'] = str(uuid.uuid4())
-    request.session['next_url'] = request.GET.get('next', '/')
+    next_url = request.GET.get('next', '/')
+    # next ends up in a redirect so it's kept to this site
+    allowed_hosts = {request.get_host()}
+    if not url_has_allowed_host_and_scheme(next_url, allowed_hosts=allowed_hosts, require_https=request.is_secure()):
+        next_url = '/'
 
     try:
         redirect_url = request.build_absolute_uri(PLUGIN_SETTINGS['REPLY_URL'])
@@ -48,17 +58,32 @@ def login(request):
             context=context
         )
 
-    auth_url = AzureADRemoteUserBackend().get_auth_url(redirect_url=redirect_url, state=request.session['state'])
+    login_state = new_login_state(next_url)
+    auth_url = get_backend().get_auth_url(
+        redirect_url=redirect_url,
+        state=login_state.state,
+        nonce=login_state.nonce,
+        code_challenge=login_state.code_challenge
+    )
     context['auth_url'] = auth_url
 
-    return render(
+    response = render(
         request,
         LOGIN_TEMPLATE,
         context
     )
+    set_login_state(response, login_state, redirect_url, secure=request.is_secure())
+    return response
 
 
 def authorize(request):
+    response = _authorize(request)
+    # Whatever happened, this login's state can't be used again
+    clear_login_state(response, request, request.build_absolute_uri(PLUGIN_SETTINGS['REPLY_URL']))
+    return response
+
+
+def _authorize(request):
 
     LOGGER.debug("Received a call to authorize")
 
@@ -67,7 +92,7 @@ def authorize(request):
         LOGGER.debug("User is already authenticated. Redirecting to login URL.")
         return redirect(PLUGIN_SETTINGS['LOGIN_URL'])
 
-    auth_backend = AzureADRemoteUserBackend()
+    auth_backend = get_backend()
 
     if not request.GET.get('code', False):
         messages.warning(request, ERROR_MAP['MISSING_AUTH_CODE'])
@@ -78,16 +103,30 @@ def authorize(request):
         redirect_url = request.build_absolute_uri(PLUGIN_SETTINGS['REPLY_URL'])
     except KeyError as ex:
         messages.warning(request, ERROR_MAP['MISSING_COMPLETE_URL'])
-        LOGGER.debug(f"Failed to build a reply URL: {ex}")
+        LOGGER.debug("Failed to build a reply URL: %s", ex)
         return redirect(PLUGIN_SETTINGS['LOGIN_URL'])
 
-    auth_result = auth_backend.acquire_user_token(request, redirect_uri=redirect_url)
-    if not auth_result:
+    login_state = read_login_state(request)
+    if login_state is None:
+        messages.error(request, ERROR_MAP['INVALID_STATE'])
+        LOGGER.debug("Received a reply with a missing, invalid or reused state")
+        return redirect(PLUGIN_SETTINGS['LOGIN_URL'])
+
+    metrics = get_metrics()
+    with metrics.phase('token_exchange'):
+        auth_result = auth_backend.acquire_user_token(
+            request,
+            redirect_uri=redirect_url,
+            nonce=login_state.nonce,
+            code_verifier=login_state.code_verifier
+        )
+    if not auth_result or 'id_token_claims' not in auth_result:
         messages.error(request, ERROR_MAP['USER_TOKEN_FAILURE'])
         LOGGER.debug("Failed to acquire a token for the user")
         return redirect(PLUGIN_SETTINGS['LOGIN_URL'])
 
-    user = auth_backend.retrieve_user(auth_result)
+    with metrics.phase('retrieve_user'):
+        user = auth_backend.retrieve_user(auth_result)
     if not user:
         messages.error(request, ERROR_MAP['ACCOUNT_CREATION_FAILED'])
         LOGGER.debug("Failed to retrieve the user's details")
@@ -95,12 +134,17 @@ def authorize(request):
 
     try:
         LOGGER.debug("Attempting to log the user in")
-        auth_backend.login(request, user)
+        with metrics.phase('login'):
+            auth_backend.login(request, user)
     except Exception as ex:
         messages.error(request, ERROR_MAP['ACCOUNT_LOGIN_FAILED'])
-        LOGGER.debug(f"Failed to log the user in: {ex}")
+        LOGGER.debug("Failed to log the user in: %s", ex)
         return redirect(PLUGIN_SETTINGS['LOGIN_URL'])
 
-    next_url = request.session.get('next_url', '/')
-    LOGGER.debug(f"Redirecting to {next_url}")
-    return redirect(next_url)
+    stale = getattr(user, 'azuread_permissions_stale', False)
+    request.session['azuread_permissions_stale'] = stale
+    if stale:
+        messages.warning(request, ERROR_MAP['STALE_PERMISSIONS'])
+
+    LOGGER.debug("Redirecting to %s", login_state.next_url)
+    return redirect(login_state.next_url)
@@ -43,6 +43,12 @@ setup(
         "Topic :: System :: Systems Administration :: Authentication/Directory"
     ],
     install_requires=[],
+    # Optional features that need more than Netbox already ships with
+    extras_require={
+        'async': ['httpx'],
+        'api': ['PyJWT[crypto]>=2.0'],
+        'metrics': ['prometheus_client'],
+    },
     python_requires=">=3.6",
     packages=find_packages(),
     include_package_data=True,